@@ -0,0 +1,284 @@
+"""
+HTTP client for the NamjaNinjaBot backend API (Django on pythonanywhere).
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import observe_backend
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds per backend endpoint
+DEFAULT_TIMEOUTS = {
+    'user': (3.05, 10),
+    'details': (3.05, 5),
+    'training': (3.05, 5),
+    'feedback': (3.05, 10),
+}
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and stays open for `reset_timeout` seconds.
+
+    Once the timeout has passed a single trial request is let through (half-open). Its outcome
+    decides whether the breaker closes again or re-opens. A trial that ends without an outcome,
+    e.g. because it was cancelled, is given up with release() so that another one can be let through.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic()-self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """False if a request may not be sent now, 'trial' if it is the half-open trial, True otherwise"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic()-self.opened_at < self.reset_timeout or self._trial:
+                return False
+            self._trial = True
+            return 'trial'
+
+    def release(self):
+        with self._lock:
+            self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info('Backend recovered, closing circuit breaker')
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.opened_at is None and self.failures >= self.threshold):
+                logger.warning('Backend failed %d times in a row, opening circuit breaker for %ss', self.failures, self.reset_timeout)
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+
+class BaseBackendClient:
+    """Per-endpoint timeouts, retry policy and circuit breaker shared by BackendClient and AsyncBackendClient.
+
+    A request asks begin() whether it may be sent and how often it may be retried, then reports each
+    attempt to attempted(), which says whether to retry and records the outcome with the breaker.
+    end() gives up the breaker's trial if the request stopped before it had an outcome.
+    """
+
+    def __init__(self, baseurl, timeouts=None, retries=2, backoff=0.25, breaker=None):
+        self.baseurl = baseurl
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+
+    def url(self, endpoint, *parts):
+        return self.baseurl+endpoint+'/'+''.join(str(part)+'/' for part in parts)
+
+    def begin(self, method, endpoint, retries=None):
+        """Returns (retries, trial), or None if the circuit breaker is open"""
+        allowed = self.breaker.allow()
+        if not allowed:
+            logger.warning('Circuit breaker open, skipping %s %s request', method, endpoint)
+            observe_backend(endpoint, method, 'breaker_open', None)
+            return None
+        if retries is None:
+            #only idempotent requests are retried after the backend has seen them
+            retries = self.retries if method == 'GET' else 0
+        return retries, allowed == 'trial'
+
+    def attempted(self, method, endpoint, attempt, retries, started, response=None, outcome=None, error=None):
+        """Record an attempt that got `response` or failed with `outcome` and `error`.
+
+        Returns the seconds to back off before retrying, or None when the request is over.
+        """
+        observe_backend(endpoint, method, outcome if response is None else response.status_code, started)
+        if outcome == 'connection_error':
+            #refused or stale keep-alive connection, retried once even for POST
+            retries = max(retries, 1)
+        failed = response is None or response.status_code >= 500
+        if failed and attempt < retries:
+            #full jitter so that retrying workers do not hit the backend in lockstep
+            return random.uniform(0, self.backoff*(2**attempt))
+        if not failed:
+            self.breaker.record_success()
+            return None
+        if response is None:
+            logger.error('%s %s request failed: %r', method, endpoint, error)
+        self.breaker.record_failure()
+        return None
+
+    def end(self, trial, finished):
+        if trial and not finished:
+            self.breaker.release()
+
+
+class BackendClient(BaseBackendClient):
+    """Keep-alive session to the backend with per-endpoint timeouts, retries and a circuit breaker.
+
+    request() returns the requests.Response, or None when the backend could not be reached or
+    the circuit breaker is open, so callers can fall back to their "Please try again later" reply.
+    """
+
+    def __init__(self, baseurl, pool_size=4, timeouts=None, retries=2, backoff=0.25, breaker=None):
+        super().__init__(baseurl, timeouts, retries, backoff, breaker)
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, endpoint, parts, retries=None, **kwargs):
+        begun = self.begin(method, endpoint, retries)
+        if begun is None:
+            return None
+        retries, trial = begun
+        kwargs.setdefault('timeout', self.timeouts.get(endpoint, (3.05, 10)))
+        url = self.url(endpoint, *parts)
+        finished = False
+        try:
+            attempt = 0
+            while True:
+                started = time.monotonic()
+                response = None
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except requests.exceptions.ConnectionError as e:
+                    delay = self.attempted(method, endpoint, attempt, retries, started, outcome='connection_error', error=e)
+                except requests.exceptions.RequestException as e:
+                    outcome = 'timeout' if isinstance(e, requests.exceptions.Timeout) else 'error'
+                    delay = self.attempted(method, endpoint, attempt, retries, started, outcome=outcome, error=e)
+                else:
+                    delay = self.attempted(method, endpoint, attempt, retries, started, response)
+                if delay is None:
+                    finished = True
+                    return response
+                time.sleep(delay)
+                attempt += 1
+        finally:
+            self.end(trial, finished)
+
+    def get(self, endpoint, parts, **kwargs):
+        return self.request('GET', endpoint, parts, **kwargs)
+
+    def post(self, endpoint, parts, **kwargs):
+        return self.request('POST', endpoint, parts, **kwargs)
+
+    def warm_up(self, timeout=5):
+        """Open the pool's keep-alive connections ahead of the first requests. Returns how many requests succeeded.
+
+        Sends HEAD requests to the base url concurrently. They bypass the circuit breaker and metrics,
+        any response will do since only the connection is wanted.
+        """
+        def head(_):
+            try:
+                self.session.head(self.baseurl, timeout=timeout).close()
+                return True
+            except requests.exceptions.RequestException as e:
+                logger.warning('Unable to open a backend connection: %s', e)
+                return False
+        with ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='BackendWarmUp') as executor:
+            return sum(executor.map(head, range(self.pool_size)))
+
+
+class BackendResponse:
+    """The parts of requests.Response that the handlers use, returned by AsyncBackendClient"""
+    __slots__ = ('status_code', 'content')
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+
+class AsyncBackendClient(BaseBackendClient):
+    """aiohttp version of BackendClient for handlers running on the async engine.
+
+    Must be used from a single event loop. Pass the breaker of the sync client so both share
+    one view of backend health.
+    """
+
+    def __init__(self, baseurl, limit=100, timeouts=None, retries=2, backoff=0.25, breaker=None):
+        super().__init__(baseurl, timeouts, retries, backoff, breaker)
+        self.limit = limit
+        self.session = None
+
+    def _get_session(self):
+        #created lazily so that it binds to the running loop
+        if self.session is None:
+            import aiohttp
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit))
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, method, endpoint, parts, retries=None, timeout=None, **kwargs):
+        begun = self.begin(method, endpoint, retries)
+        if begun is None:
+            return None
+        retries, trial = begun
+        #imported here so that the sync mode does not pay for it at startup
+        import aiohttp
+        connect, read = timeout or self.timeouts.get(endpoint, (3.05, 10))
+        kwargs['timeout'] = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        url = self.url(endpoint, *parts)
+        finished = False
+        try:
+            session = self._get_session()
+            attempt = 0
+            while True:
+                started = time.monotonic()
+                response = None
+                try:
+                    async with session.request(method, url, **kwargs) as resp:
+                        response = BackendResponse(resp.status, await resp.read())
+                except (aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError) as e:
+                    delay = self.attempted(method, endpoint, attempt, retries, started, outcome='connection_error', error=e)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    outcome = 'timeout' if isinstance(e, asyncio.TimeoutError) else 'error'
+                    delay = self.attempted(method, endpoint, attempt, retries, started, outcome=outcome, error=e)
+                else:
+                    delay = self.attempted(method, endpoint, attempt, retries, started, response)
+                if delay is None:
+                    finished = True
+                    return response
+                await asyncio.sleep(delay)
+                attempt += 1
+        finally:
+            #e.g. cancelled, a trial that never got an outcome would keep the breaker from ever closing
+            self.end(trial, finished)
+
+    async def get(self, endpoint, parts, **kwargs):
+        return await self.request('GET', endpoint, parts, **kwargs)
+
+    async def post(self, endpoint, parts, **kwargs):
+        return await self.request('POST', endpoint, parts, **kwargs)
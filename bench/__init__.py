@@ -0,0 +1,3 @@
+"""
+Offline benchmarks for NamjaNinjaBot: a stand-in backend and a load generator.
+"""
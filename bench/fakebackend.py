@@ -0,0 +1,158 @@
+"""
+Stand-in for the NamjaNinjaBot backend API (api/namjaninjabot/) with latency and error injection.
+
+Run on its own and point the bot at it with BACKEND_URL:
+
+    python -m bench.fakebackend --port 8000 --latency 0.1 --error-rate 0.01
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from schedule import DATETIME_FORMAT, SGT
+
+API_PATH = '/api/namjaninjabot/'
+
+
+def make_training(count=30, now=None):
+    """Training list in the backend format: `count` activities around now, NDP day, the post celebration and a TBA one"""
+    now = (now or datetime.now(SGT)).replace(tzinfo=None, microsecond=0)
+    ndp = datetime(now.year if now < datetime(now.year, 8, 9, 20) else now.year+1, 8, 9, 20)
+    items = []
+    for i in range(count):
+        start = now+timedelta(days=i-count//4, hours=i % 5)
+        items.append({
+            "title": "NDP Training %d" % (i+1),
+            "location": "Zoom" if i % 3 == 0 else "Senja Soka Centre",
+            "datetime_start": start.strftime(DATETIME_FORMAT),
+            "datetime_end": (start+timedelta(hours=3)).strftime(DATETIME_FORMAT),
+            "Note": "Nil" if i % 2 else "Bring a pen and notebook",
+        })
+    items.append({"title": "NDP %d" % ndp.year, "location": "The Float @ Marina Bay",
+                  "datetime_start": (ndp-timedelta(hours=6)).strftime(DATETIME_FORMAT),
+                  "datetime_end": ndp.strftime(DATETIME_FORMAT), "Note": "Nil"})
+    items.append({"title": "NDP %d Post Celebration" % ndp.year, "location": "Senja Soka Centre",
+                  "datetime_start": (ndp+timedelta(days=14)).strftime(DATETIME_FORMAT),
+                  "datetime_end": (ndp+timedelta(days=14, hours=2)).strftime(DATETIME_FORMAT), "Note": "Nil"})
+    items.append({"title": "Costume fitting", "location": "TBA", "datetime_start": "TBA", "datetime_end": "TBA", "Note": "Nil"})
+    random.shuffle(items)
+    return items
+
+
+DETAILS = {
+    "zoomlink": "https://zoom.us/j/1234567890",
+    "training_attire": ["White t-shirt", "Black shorts", "Sports shoes"],
+    "training_bring": ["Water bottle", "Cap", "Sunblock", "Raincoat"],
+    "lastupdate": "1 Jul 2022",
+}
+
+
+class FakeBackend:
+    """Threaded HTTP server answering the user, details, training and feedback endpoints.
+
+    Every request sleeps for `latency` plus up to `jitter` seconds and fails with a 500 with
+    probability `error_rate`. Participant codes starting with "X" are invalid and "Blocked" is
+    a blocked account, every other code logs in.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, activities=30, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.training = json.dumps(make_training(activities)).encode()
+        self.details = json.dumps(DETAILS).encode()
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                backend.handle(self, 'GET')
+
+            def do_POST(self):
+                backend.handle(self, 'POST')
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d%s' % (host, port, API_PATH)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='FakeBackend', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request, method):
+        body = request.rfile.read(int(request.headers.get('Content-Length', 0)))
+        parts = request.path[len(API_PATH):].strip('/').split('/') if request.path.startswith(API_PATH) else ['']
+        endpoint = parts[0]
+        with self._lock:
+            self.requests[method+' '+endpoint] += 1
+        time.sleep(self.latency+random.uniform(0, self.jitter))
+        if random.random() < self.error_rate:
+            self.respond(request, 500, b'{"detail": "injected error"}')
+        elif method == 'GET' and endpoint in ('training', 'details'):
+            if not request.headers.get('token'):
+                self.respond(request, 401, b'{"detail": "missing token"}')
+            else:
+                self.respond(request, 200, self.training if endpoint == 'training' else self.details)
+        elif method == 'POST' and endpoint == 'user':
+            code = parse_qs(body.decode()).get('participantCode', [''])[0]
+            if code == 'Blocked':
+                self.respond(request, 423, b'{}')
+            elif code.startswith('X'):
+                self.respond(request, 200, json.dumps({"token": "", "loginAttempts": 1}).encode())
+            else:
+                self.respond(request, 200, json.dumps({"token": "bench-"+code, "loginAttempts": 0}).encode())
+        elif method == 'POST' and endpoint == 'feedback':
+            self.respond(request, 201, b'{}')
+        else:
+            self.respond(request, 404, b'{"detail": "not found"}')
+
+    def respond(self, request, status, body):
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many extra seconds, uniformly random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 500')
+    parser.add_argument('--activities', type=int, default=30, help='number of activities in the training list')
+    args = parser.parse_args()
+    backend = FakeBackend(args.latency, args.jitter, args.error_rate, args.activities, args.host, args.port)
+    print('Serving the backend API on', backend.url)
+    try:
+        backend.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
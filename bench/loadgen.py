@@ -0,0 +1,260 @@
+"""
+Load generator for NamjaNinjaBot. Feeds synthetic Telegram updates into the dispatcher built by
+bot.build_updater(), against the stand-in backend, and reports reply latency per query type.
+
+    python -m bench.loadgen --users 50 --rounds 3 --latency 0.05
+    python -m bench.loadgen --users 50 --async --record trace.jsonl
+    python -m bench.loadgen --replay trace.jsonl --speed 2
+
+Each virtual user logs in, asks every keyboard query `rounds` times and submits feedback, waiting
+for the bot's reply before sending its next message. A recorded trace is replayed open loop: the
+messages are sent at their recorded times whether or not the earlier ones have been answered.
+Latency is measured from queueing an update to the first message the bot sends back for it.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+
+from bench.fakebackend import FakeBackend
+
+# The reply keyboard queries, in the order virtual users ask them
+QUERIES = ("Next NDP activity?", "Show all NDP activities", "Zoom link?", "Countdown", "Daily encouragement", "Last updated?")
+
+# Replies that mean the bot could not get an answer from the backend
+FAILURE_PREFIXES = ("Unable to", "Failed to")
+
+# Messages the bot sends back per kind of update, 1 when not listed
+REPLIES = {'feedback': 2}
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return float('nan')
+    return values[min(len(values)-1, max(0, int(round(p/100*len(values)+0.5))-1))]
+
+
+class ReplyTracker:
+    """Matches the messages the bot sends to the updates sent to each chat, oldest first"""
+
+    def __init__(self):
+        self._pending = defaultdict(deque)  # chat id -> [kind, queued at, replies left, answered]
+        self._cond = threading.Condition()
+        self.latencies = defaultdict(list)
+        self.failed = defaultdict(int)
+        self.timeouts = defaultdict(int)
+        self.unexpected = 0
+
+    def expect(self, chat_id, kind):
+        with self._cond:
+            self._pending[chat_id].append([kind, time.perf_counter(), REPLIES.get(kind, 1), False])
+
+    def on_message(self, chat_id, text):
+        now = time.perf_counter()
+        with self._cond:
+            pending = self._pending.get(chat_id)
+            if not pending:
+                self.unexpected += 1
+                return
+            entry = pending[0]
+            if not entry[3]:
+                entry[3] = True
+                self.latencies[entry[0]].append(now-entry[1])
+                if text.startswith(FAILURE_PREFIXES):
+                    self.failed[entry[0]] += 1
+            entry[2] -= 1
+            if entry[2] <= 0:
+                pending.popleft()
+                self._cond.notify_all()
+
+    def wait(self, chat_id=None, timeout=30):
+        """Wait until every update of chat_id (or of all chats) is answered. Unanswered ones count as timeouts"""
+        with self._cond:
+            chats = [chat_id] if chat_id is not None else list(self._pending)
+            done = self._cond.wait_for(lambda: not any(self._pending[chat] for chat in chats), timeout)
+            if not done:
+                for chat in chats:
+                    for entry in self._pending.pop(chat, ()):
+                        if not entry[3]:
+                            self.timeouts[entry[0]] += 1
+            return done
+
+
+def make_request_class(tracker):
+    from telegram.utils.request import Request
+    messageIds = itertools.count(1)
+
+    class BenchRequest(Request):
+        """Answers Bot API calls locally instead of sending them to Telegram"""
+
+        def post(self, url, data=None, timeout=None):
+            method = url.rsplit('/', 1)[1]
+            if method == 'getMe':
+                return {"id": 1, "is_bot": True, "first_name": "NamjaNinjaBot", "username": "NamjaNinjaBot"}
+            if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+                chat_id = int(data['chat_id'])
+                tracker.on_message(chat_id, data.get('text', ''))
+                return {"message_id": next(messageIds), "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"}, "text": data.get('text', '')}
+            return True
+
+    return BenchRequest
+
+
+def user_script(index, rounds, feedback=True):
+    """(kind, text) messages sent by one virtual user"""
+    steps = [('start', '/start'), ('login', 'P%05d' % index)]
+    for _ in range(rounds):
+        steps.extend((query, query) for query in QUERIES)
+    if feedback:
+        steps.append(('feedback', '/feedback'))
+        steps.append(('feedback_text', 'Benchmark feedback from user %d' % index))
+    return steps
+
+
+class LoadGenerator:
+    def __init__(self, updater, tracker, timeout=30):
+        self.updater = updater
+        self.tracker = tracker
+        self.timeout = timeout
+        self.trace = []
+        self._traceLock = threading.Lock()
+        self._updateIds = itertools.count(1)
+        self._started = None
+
+    def send(self, chat_id, kind, text):
+        from telegram import Update
+        update_id = next(self._updateIds)
+        message = {"message_id": update_id, "date": int(time.time()), "text": text,
+                   "chat": {"id": chat_id, "type": "private"},
+                   "from": {"id": chat_id, "is_bot": False, "first_name": "User%d" % chat_id, "username": "user%d" % chat_id}}
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        with self._traceLock:
+            self.trace.append({"t": round(time.perf_counter()-self._started, 6), "chat": chat_id, "kind": kind, "text": text})
+        self.tracker.expect(chat_id, kind)
+        self.updater.update_queue.put(Update.de_json({"update_id": update_id, "message": message}, self.updater.bot))
+
+    def run_users(self, users, rounds, think=0.0):
+        """Closed loop: every virtual user waits for the answer before sending its next message"""
+        def run(index):
+            chat_id = 100000+index
+            for kind, text in user_script(index, rounds):
+                self.send(chat_id, kind, text)
+                self.tracker.wait(chat_id, self.timeout)
+                if think:
+                    time.sleep(think)
+        self._started = time.perf_counter()
+        threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter()-self._started
+
+    def replay(self, events, speed=1.0):
+        """Open loop: messages are sent at their recorded offsets, divided by speed"""
+        self._started = time.perf_counter()
+        for event in sorted(events, key=lambda e: e["t"]):
+            delay = self._started+event["t"]/speed-time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.send(event["chat"], event["kind"], event["text"])
+        self.tracker.wait(timeout=self.timeout)
+        return time.perf_counter()-self._started
+
+
+def report(tracker, elapsed, out=sys.stdout):
+    kinds = sorted(set(tracker.latencies) | set(tracker.timeouts), key=lambda k: (k not in QUERIES, k))
+    print('%-26s %7s %7s %8s %9s %9s %9s %10s' % ('kind', 'count', 'failed', 'timeouts', 'p50 ms', 'p95 ms', 'p99 ms', 'updates/s'), file=out)
+    everything = []
+    for kind in kinds:
+        values = sorted(tracker.latencies[kind])
+        everything.extend(values)
+        print('%-26s %7d %7d %8d %9.1f %9.1f %9.1f %10.1f' % (
+            kind, len(values), tracker.failed[kind], tracker.timeouts[kind],
+            percentile(values, 50)*1000, percentile(values, 95)*1000, percentile(values, 99)*1000, len(values)/elapsed), file=out)
+    everything.sort()
+    print('%-26s %7d %7d %8d %9.1f %9.1f %9.1f %10.1f' % (
+        'all', len(everything), sum(tracker.failed.values()), sum(tracker.timeouts.values()),
+        percentile(everything, 50)*1000, percentile(everything, 95)*1000, percentile(everything, 99)*1000, len(everything)/elapsed), file=out)
+    if tracker.unexpected:
+        print('%d messages could not be matched to an update' % tracker.unexpected, file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20, help='concurrent virtual users')
+    parser.add_argument('--rounds', type=int, default=2, help='times each user asks every query')
+    parser.add_argument('--think', type=float, default=0.0, help='seconds a user waits between messages')
+    parser.add_argument('--latency', type=float, default=0.05, help='backend latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random backend latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of backend requests failing with a 500')
+    parser.add_argument('--workers', type=int, help='dispatcher workers (WORKERS)')
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='run with ASYNC_MODE=1')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for a reply')
+    parser.add_argument('--record', metavar='FILE', help='write the updates sent to a JSONL trace')
+    parser.add_argument('--replay', metavar='FILE', help='replay a JSONL trace instead of simulating users')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed factor')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    backend = FakeBackend(args.latency, args.jitter, args.error_rate).start()
+    #bot reads its configuration when imported
+    os.environ['BACKEND_URL'] = backend.url
+    os.environ.setdefault('TOKEN', '123456:bench')
+    os.environ.setdefault('METRICS_PORT', '0')
+    #reminders would be sent to the virtual users in the middle of a run
+    os.environ.setdefault('REMINDER_OFFSETS', '')
+    os.environ.setdefault('DAILY_ENCOURAGEMENT_TIME', '')
+    os.environ.setdefault('FEEDBACK_SPOOL', os.path.join(tempfile.gettempdir(), 'namjaninjabot-bench-feedback.jsonl'))
+    os.environ['ASYNC_MODE'] = '1' if args.async_mode else os.environ.get('ASYNC_MODE', '0')
+    if args.workers:
+        os.environ['WORKERS'] = str(args.workers)
+    import bot
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    tracker = ReplyTracker()
+    updater = bot.build_updater(request=make_request_class(tracker)(con_pool_size=8))
+    dispatcher = updater.dispatcher
+    ready = threading.Event()
+    updater.job_queue.start()
+    threading.Thread(target=dispatcher.start, kwargs={'ready': ready}, name='dispatcher', daemon=True).start()
+    ready.wait()
+
+    generator = LoadGenerator(updater, tracker, args.timeout)
+    try:
+        if args.replay:
+            with open(args.replay) as f:
+                events = [json.loads(line) for line in f if line.strip()]
+            elapsed = generator.replay(events, args.speed)
+        else:
+            elapsed = generator.run_users(args.users, args.rounds, args.think)
+    finally:
+        dispatcher.stop()
+        updater.job_queue.stop()
+        bot.shutdown()
+        if dispatcher.persistence is not None:
+            dispatcher.persistence.flush()
+        backend.stop()
+
+    if args.record:
+        with open(args.record, 'w') as f:
+            for event in generator.trace:
+                f.write(json.dumps(event)+'\n')
+    print('%s mode, %d workers, backend latency %.0f ms, %.1f s elapsed' % (
+        'async' if bot.ASYNC_MODE else 'sync', bot.WORKERS, args.latency*1000, elapsed))
+    report(tracker, elapsed)
+    print('backend requests:', dict(backend.requests))
+
+
+if __name__ == '__main__':
+    main()
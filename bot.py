@@ -2,46 +2,465 @@
 Telegram Bot that provides training information and encouragement to SGS NDP 2022 participants.
 """
 
+import asyncio
+import contextlib
+import contextvars
+import functools
+import io
 import logging
 import os
-from datetime import datetime
-from zoneinfo import ZoneInfo
+from datetime import datetime, timedelta
 import json
-import re
-import requests
 import math
+import threading
+import time
+import zlib
 
-from telegram import ReplyKeyboardMarkup, KeyboardButton, ChatAction
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, ConversationHandler
+#taken before the third party imports so that the time to ready includes them
+startedAt = time.monotonic()
+
+import pytz
+from telegram import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup, ChatAction
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.error import BadRequest, TelegramError, Unauthorized
+from telegram import Update
+from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, CallbackContext, ContextTypes, ConversationHandler, TypeHandler
+from telegram.utils.request import Request
+
+from backend import AsyncBackendClient, BackendClient
+from cache import TTLCache
+from delivery import DelayedCalls, DeliveryQueue, QueuedBot
+from engine import AsyncEngine
+import metrics
+from logpipe import LazyUser, elapsed_ms, parse_sample_rates, setup_logging
+from persistence import SQLitePersistence
+from profiler import PROFILER
+from ratelimit import RateLimiter
+from schedule import ScheduleIndex, ScheduleSnapshot, SGT, ATTIRE, BRING_LIST, COSTUME, ZOOM, diff
+from sessions import ConversationStates, Session, bind_user_data, evict_sessions, open_store, session_stats
+from shard import ShardRouter
+from spool import FeedbackSpool
 
 TOKEN = os.environ["TOKEN"]
 
-# Enable logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging.INFO)
+# Enable logging. Records are queued by the handlers and written by a background thread unless
+# LOG_QUEUE=0. LOG_FORMAT=json writes one JSON object per line, LOG_SAMPLE (e.g. "question=0.1")
+# keeps only a fraction of the informational records of the given events
+setup_logging(level=logging.INFO,
+              json_output=os.environ.get("LOG_FORMAT")=="json",
+              sample_rates=parse_sample_rates(os.environ.get("LOG_SAMPLE", "")),
+              use_queue=os.environ.get("LOG_QUEUE", "1")!="0")
 
 logger = logging.getLogger(__name__)
 
 FIRST_STEP = range(1)
 LOGIN_STEP = range(1)
 
-baseurl = 'https://telegrambotsdb.pythonanywhere.com/api/namjaninjabot/'
+# BACKEND_URL points the bot at another backend, e.g. the stand-in one used by the benchmarks
+baseurl = os.environ.get("BACKEND_URL", 'https://telegrambotsdb.pythonanywhere.com/api/namjaninjabot/')
 
-#/start handler
-def start(update, context: CallbackContext):
-    """Send a message when the command /start is issued."""
-    context.bot.send_chat_action(chat_id=update.message.chat.id, action=ChatAction.TYPING, timeout=None)
+# Number of dispatcher worker threads. The backend connection pool is sized to match
+WORKERS = int(os.environ.get("WORKERS", "4"))
+backend = BackendClient(baseurl, pool_size=WORKERS)
+
+# Set SHARDS to more than 1 to handle updates in that many worker processes, sharded by chat id. The
+# webhook process only routes updates, SHARD_INDEX is set in the worker processes
+SHARDS = int(os.environ.get("SHARDS", "1"))
+SHARD_INDEX = int(os.environ["SHARD_INDEX"]) if "SHARD_INDEX" in os.environ else None
+
+# Set ASYNC_MODE=1 to run the handlers that wait on the backend as coroutines on an event loop.
+# engine and asyncBackend are created by start_engine() in that mode
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "0").lower() in ("1", "true", "yes")
+engine = None
+asyncBackend = None
+
+# Handler and backend metrics are served in the Prometheus text format on METRICS_HOST:METRICS_PORT,
+# next to the webhook. METRICS_PORT=0 turns the endpoint off
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+
+# Admins (comma separated telegram ids in ADMIN_IDS) can send "/profile [seconds] [fraction]" to profile that
+# fraction of the updates for that many seconds, PROFILE_SECONDS and PROFILE_RATE by default. The report
+# is sent to them when the time is up, "/profile stop" ends it early. PROFILE_ON_START=1 profiles the
+# first PROFILE_SECONDS after startup and writes the report to PROFILE_REPORT
+ADMIN_IDS = [int(user_id) for user_id in os.environ.get("ADMIN_IDS", "").split(",") if user_id.strip()]
+PROFILE_SECONDS = int(os.environ.get("PROFILE_SECONDS", "60"))
+PROFILE_RATE = float(os.environ.get("PROFILE_RATE", "0.1"))
+PROFILE_ON_START = os.environ.get("PROFILE_ON_START", "0") == "1"
+PROFILE_REPORT = os.environ.get("PROFILE_REPORT", "profile_report.txt")
+if SHARD_INDEX is not None:
+    PROFILE_REPORT += "."+str(SHARD_INDEX)
+
+# Before the webhook starts serving, warm_up() opens the backend and Telegram connections and fetches,
+# parses and renders the schedule so that the first users after a restart are answered as fast as
+# later ones. /ready on the metrics port answers 503 until then. WARMUP=0 skips it
+WARMUP = os.environ.get("WARMUP", "1") != "0"
+ready = threading.Event()
+startupTimings = {}
+
+# Outgoing messages are queued to stay within Telegram's flood limits: DELIVERY_RATE messages per second
+# overall, and reminders DELIVERY_CHAT_RATE per second per chat, DELIVERY_CHAT_BURST at once. Replies to
+# users go before reminders and never wait for their chat's limit. delivery is created by build_updater()
+DELIVERY_RATE = float(os.environ.get("DELIVERY_RATE", "30"))
+DELIVERY_CHAT_RATE = float(os.environ.get("DELIVERY_CHAT_RATE", "1"))
+DELIVERY_CHAT_BURST = int(os.environ.get("DELIVERY_CHAT_BURST", "3"))
+DELIVERY_SENDERS = int(os.environ.get("DELIVERY_SENDERS", str(WORKERS)))
+delivery = None
+
+# Feedback is appended to the FEEDBACK_SPOOL file and the user thanked right away. A background thread
+# submits it to the backend, FEEDBACK_BATCH at a time, retrying every FEEDBACK_RETRY seconds (doubling)
+# while the backend is unavailable. Set FEEDBACK_SPOOL to an empty string to submit while the user waits.
+# feedbackSpool is created by build_updater()
+FEEDBACK_SPOOL = os.environ.get("FEEDBACK_SPOOL", "feedback_spool.jsonl")
+if FEEDBACK_SPOOL and SHARD_INDEX is not None:
+    FEEDBACK_SPOOL += "."+str(SHARD_INDEX)
+FEEDBACK_BATCH = int(os.environ.get("FEEDBACK_BATCH", "20"))
+FEEDBACK_RETRY = int(os.environ.get("FEEDBACK_RETRY", "5"))
+feedbackSpool = None
+
+# Path of the SQLite file that logins and conversation states are saved to. Sessions are only kept
+# in memory when not set. Shard workers share it, each only loading and saving the users of its chats
+SESSION_DB = os.environ.get("SESSION_DB")
+
+# Store that logins and conversation states are kept in instead, shared by every bot process using it:
+# "memory" for this process only, or the host:port of a store started with `python -m sessions`.
+# SESSION_AUTHKEY is required for the latter and must match the store's, there is no default. Takes the
+# place of SESSION_DB when set. Each process must receive every update of the chats it handles, as the
+# SHARDS workers do, since conversation states are read before the user's session is locked. With
+# several processes, turn the reminders off on all but one of them.
+# sessionStore is created by build_updater()
+SESSION_STORE = os.environ.get("SESSION_STORE", "")
+SESSION_AUTHKEY = os.environ.get("SESSION_AUTHKEY", "").encode()
+sessionStore = None
+
+# Sessions of users who never logged in are evicted after SESSION_ANONYMOUS_TTL seconds without an update,
+# logged in ones after SESSION_IDLE_TTL (0 keeps them). Beyond SESSION_MAX sessions the least recently
+# seen are evicted. Checked every SESSION_EVICT_INTERVAL seconds
+SESSION_ANONYMOUS_TTL = int(os.environ.get("SESSION_ANONYMOUS_TTL", "3600"))
+SESSION_IDLE_TTL = int(os.environ.get("SESSION_IDLE_TTL", str(30*24*60*60)))
+SESSION_MAX = int(os.environ.get("SESSION_MAX", "50000"))
+SESSION_EVICT_INTERVAL = int(os.environ.get("SESSION_EVICT_INTERVAL", "300"))
+
+# Training and details payloads are the same for every participant, so they are cached per endpoint
+# and shared between users. Concurrent misses are coalesced into a single backend request.
+backendCache = TTLCache(maxsize=int(os.environ.get("CACHE_MAXSIZE", "16")),
+                        ttl=int(os.environ.get("CACHE_TTL", "60")),
+                        maxbytes=int(os.environ.get("CACHE_MAXBYTES", str(4*1024*1024))))
+
+# Parsers applied once when a payload is loaded, the parsed result is what gets cached
+PARSERS = {
+    'training': ScheduleIndex,
+}
+
+# Once a logged in user's credentials are available, the handlers answer from scheduleSnapshot instead.
+# It is synced every SCHEDULE_SYNC_INTERVAL seconds by fetching the details, and the training list only
+# when their lastupdate has moved or the snapshot is older than SCHEDULE_MAX_AGE seconds. A snapshot
+# older than that is not answered from, e.g. while syncing fails. Syncs use the credentials of the
+# most recent logins, trying up to SCHEDULE_SYNC_TRIES users when the backend refuses them. With
+# SCHEDULE_NOTIFY=1 the logged in users are told about changed upcoming activities.
+# SCHEDULE_SYNC_INTERVAL=0 turns syncing off
+SCHEDULE_SYNC_INTERVAL = int(os.environ.get("SCHEDULE_SYNC_INTERVAL", "60"))
+SCHEDULE_MAX_AGE = int(os.environ.get("SCHEDULE_MAX_AGE", "21600"))
+SCHEDULE_SYNC_TRIES = int(os.environ.get("SCHEDULE_SYNC_TRIES", "3"))
+SCHEDULE_NOTIFY = os.environ.get("SCHEDULE_NOTIFY", "0") == "1"
+scheduleSnapshot = None
+SCHEDULE_SYNCS = metrics.REGISTRY.counter('namjaninjabot_schedule_syncs_total', 'Schedule syncs, by outcome', ('outcome',))
+
+def parse_backend_data(endpoint, response):
+    if response is not None and response.status_code == 200:
+        data = json.loads(response.text)
+        if endpoint in PARSERS:
+            data = PARSERS[endpoint](data)
+        return (data, len(response.content))
+    return None
+
+#scheduleSnapshot, or None if there is none or it is older than SCHEDULE_MAX_AGE
+def current_snapshot():
+    snapshot = scheduleSnapshot
+    if snapshot is None or time.monotonic()-snapshot.fetched >= SCHEDULE_MAX_AGE:
+        return None
+    return snapshot
+
+#fetch training/details data for a logged in user. Returns None if backend request failed
+def get_backend_data(endpoint, partCode, telegramid, token):
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        return getattr(snapshot, endpoint)
+    def load():
+        with backend_wait():
+            response = backend.get(endpoint, [partCode, telegramid, 1], headers={"token": token})
+        return parse_backend_data(endpoint, response)
+    loaded = backendCache.get_or_load(endpoint, load, size=lambda v: v[1])
+    if loaded is None:
+        return None
+    return loaded[0]
+
+async def get_backend_data_async(endpoint, partCode, telegramid, token):
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        return getattr(snapshot, endpoint)
+    async def load():
+        with backend_wait():
+            response = await asyncBackend.get(endpoint, [partCode, telegramid, 1], headers={"token": token})
+        return parse_backend_data(endpoint, response)
+    loaded = await backendCache.get_or_load_async(endpoint, load, size=lambda v: v[1])
+    if loaded is None:
+        return None
+    return loaded[0]
+
+ENDED_REPLY = "NDP 2022 has come to an end. Thank you for using NamjaNinjaBot and hope it has helped you on this journey. May you continue to achieve more victories in the future! NamjaNinjaBot signing off~"
+
+# Rendered schedule replies keyed by query and schedule version. Each entry expires when the next
+# activity ends since that is when the answer changes
+replyCache = TTLCache(maxsize=64, ttl=24*60*60)
+
+def cached_reply(key, schedule, today, render):
+    reply = replyCache.get(key)
+    if reply is None:
+        reply = render()
+        nextActivity = schedule.next_activity(today)
+        ttl = None if nextActivity is None else (nextActivity.end-today).total_seconds()
+        #paginated replies are tuples of pages
+        size = sum(map(len, reply)) if isinstance(reply, tuple) else len(reply)
+        replyCache.set(key, reply, ttl=ttl, size=size)
+    return reply
+
+#strftime without zero padded day and hour
+def format_datetime(value, fmt):
+    return value.strftime(fmt).replace(' 0', ' ')
+
+# Fields of the details payload that render_next_activity() shows
+NEXT_ACTIVITY_DETAILS = ("zoomlink", "training_attire", "training_bring")
+
+#checksum of the details shown with the next activity, they can change without lastupdate changing
+def next_activity_details_version(dataDets):
+    return zlib.crc32(json.dumps([dataDets[field] for field in NEXT_ACTIVITY_DETAILS]).encode())
+
+#reply for "Next NDP activity?"
+def render_next_activity(schedule, dataDets, today):
+    ndp=schedule.ndp_day
+    postCeleb=schedule.post_celebration
+    nextActivity=schedule.next_activity(today)
+    # Check if pass 9 Aug
+    if ndp is not None and today > ndp.end and postCeleb is not None and postCeleb.end is None:
+        return "Hope NamjaNinjaBot was useful to you in some way or another. The NDP Post Celebration Details have not been updated or released. This will be updated in due time. See you at the post celebrations and congratulations on completing NDP 2022!"
+    # Check if pass post celebrations
+    if (postCeleb is not None and postCeleb.end is not None and today > postCeleb.end) or nextActivity is None:
+        return ENDED_REPLY
+    return render_activity(nextActivity, dataDets)
+
+#details of one activity, as in the reply for "Next NDP activity?"
+def render_activity(activity, dataDets):
+    dateToFormat=activity.start or activity.end
+    reply=["*", activity.title, "*\n📍: ", activity.location, "\n📅:", format_datetime(dateToFormat, " %d %b %Y, %a"), "\n🕓:"]
+    if activity.start is not None:
+        reply.append(format_datetime(activity.start, " %I:%M%p -"))
+    else:
+        reply.append(" TBA -")
+    reply.append(format_datetime(activity.end, " %I:%M%p"))
+    flags=activity.flags
+    if activity.note!="Nil":
+        reply+=["\n📝: ", activity.note]
+    if flags & ZOOM:
+        reply+=["\nZoom Link: ", dataDets["zoomlink"]]
+    if flags & ATTIRE:
+        reply.append("\n\nAttire: ")
+        for attire in dataDets["training_attire"]:
+            reply+=["\n    - ", attire]
+        if flags & BRING_LIST:
+            reply.append("\nThings to Bring: ")
+            i=0
+            for i, item in enumerate(dataDets["training_bring"], 1):
+                reply+=["\n    ", str(i), ") ", item]
+            if flags & COSTUME:
+                reply+=["\n    ", str(i+1), ") Costume"]
+    return "".join(reply)
+
+# "Show all NDP activities" is answered ALL_PAGE_SIZE activities at a time, with buttons to flip through the pages
+ALL_PAGE_SIZE = int(os.environ.get("ALL_PAGE_SIZE", "10"))
+
+#pages of the reply for "Show all NDP activities", each within Telegram's message length
+def render_all_activities(schedule, today):
+    #sorted by end datetime with TBA activities at the back
+    sortedRemainingTrain=schedule.remaining(today)
+    if len(sortedRemainingTrain)==0:
+        return (ENDED_REPLY,)
+    pages=[]
+    page=[]
+    length=0
+    for i, activity in enumerate(sortedRemainingTrain, 1):
+        reply=["\n", str(i), ") ", activity.title, ": "]
+        if activity.end is not None:
+            reply.append(format_datetime(activity.end, " %d %b %Y (%a)"))
+        else:
+            reply.append("TBA")
+        if activity.start is not None:
+            reply+=[", ", format_datetime(activity.start, " %I:%M%p -")]
+        else:
+            reply.append(", TBA - ")
+        if activity.end is not None:
+            reply.append(format_datetime(activity.end, " %I:%M%p"))
+        else:
+            reply.append("TBA")
+        reply+=[" @ ", activity.location]
+        line="".join(reply)
+        #room is left for the header
+        if page and (len(page)>=ALL_PAGE_SIZE or length+len(line)>MAX_MESSAGE_LENGTH-64):
+            pages.append(page)
+            page=[]
+            length=0
+        page.append(line)
+        length+=len(line)
+    pages.append(page)
+    if len(pages)==1:
+        return ("*NDP Activity Schedule*"+"".join(pages[0]),)
+    return tuple("*NDP Activity Schedule* ("+str(n)+"/"+str(len(pages))+")"+"".join(page) for n, page in enumerate(pages, 1))
+
+#prev/next buttons under a page of "Show all NDP activities", None when there is only one page
+def page_keyboard(version, page, count):
+    buttons=[]
+    if page>0:
+        buttons.append(InlineKeyboardButton("◀ Prev", callback_data="all "+str(version)+" "+str(page-1)))
+    if page<count-1:
+        buttons.append(InlineKeyboardButton("Next ▶", callback_data="all "+str(version)+" "+str(page+1)))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+# TYPING_MODE "adaptive" only shows the typing indicator when a request to the backend made for an answer
+# takes longer than TYPING_DELAY seconds, answers from the caches never start its timer. "always" sends it
+# before every answer and "off" never does. typingTimer is created by build_updater()
+TYPING_MODE = os.environ.get("TYPING_MODE", "adaptive")
+TYPING_DELAY = float(os.environ.get("TYPING_DELAY", "0.5"))
+typingTimer = None
+
+# (bot, chat id) of the slow handler running in this thread or task, for backend_wait()
+typingChat = contextvars.ContextVar('typingChat', default=None)
+
+def send_typing(bot, chat_id):
+    delivery.submit(chat_id, bot.send_chat_action, chat_id, ChatAction.TYPING, timeout=5)
+
+#wraps the backend requests of slow handlers: shows the typing indicator in the handler's chat if the
+#request takes longer than TYPING_DELAY
+@contextlib.contextmanager
+def backend_wait():
+    chat = typingChat.get()
+    if chat is None or TYPING_MODE != "adaptive" or typingTimer is None:
+        yield
+        return
+    call = typingTimer.call_later(TYPING_DELAY, send_typing, *chat)
+    try:
+        yield
+    finally:
+        call.cancel()
+
+#typing indicator for handlers. slow marks the handlers that wait on the backend
+def with_typing(handler=None, slow=False):
+    if handler is None:
+        return functools.partial(with_typing, slow=slow)
+    @functools.wraps(handler)
+    def wrapper(update, context):
+        if TYPING_MODE == "always":
+            context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING, timeout=5)
+        if not slow:
+            return handler(update, context)
+        token = typingChat.set((context.bot, update.effective_chat.id))
+        try:
+            return handler(update, context)
+        finally:
+            typingChat.reset(token)
+    return wrapper
+
+#typing indicator for the async engine's handlers, each runs in its own task so typingChat is its own
+def with_typing_async(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        if TYPING_MODE == "always":
+            engine.fire(context.bot.send_chat_action, chat_id=update.effective_chat.id, action=ChatAction.TYPING, timeout=5)
+        typingChat.set((context.bot, update.effective_chat.id))
+        return await handler(update, context)
+    return wrapper
+
+# Keyboard of the queries, shown once logged in
+QUERY_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("Next NDP activity?")],
+    [KeyboardButton("Show all NDP activities")],
+    [KeyboardButton("Zoom link?")],
+    [KeyboardButton("Countdown")],
+    [KeyboardButton("Daily encouragement")],
+    [KeyboardButton("Last updated?")],
+])
+
+# /start resumes a login for LOGIN_TTL seconds after it was made instead of asking for the participant
+# code again, 0 resumes it for as long as the session is kept. /login always asks
+LOGIN_TTL = int(os.environ.get("LOGIN_TTL", str(7*24*60*60)))
+
+#whether the user holds a session token that has not expired locally. Logins saved before loginTime
+#was recorded count as fresh
+def login_valid(user_data):
+    if not is_logged_in(user_data):
+        return False
+    loginTime = user_data.get("loginTime")
+    return not LOGIN_TTL or loginTime is None or time.time()-loginTime < LOGIN_TTL
+
+#asks for the participant code, dropping the current login
+def begin_login(update, context, handler):
     #reset
     context.user_data.pop('participantCode', None)
     context.user_data.pop('token', None)
+    context.user_data.pop('loginTime', None)
     context.user_data["cancelCmd"]="login"
     context.user_data["loginTriesNonText"]=0
     update.message.reply_text("What's your participant code:")
-    logging.info('User attempting login: '+update.message.from_user.first_name+ ' ('+str(update.message.from_user.id)+')')
+    logger.info('User attempting login: %s', LazyUser(update.message.from_user), extra={'event': 'login_start', 'handler': handler})
     return LOGIN_STEP
 
-#start: login
-def login_step(update, context):
+#/start handler
+@metrics.instrument('start')
+@with_typing
+def start(update, context: CallbackContext):
+    """Send a message when the command /start is issued."""
+    if login_valid(context.user_data):
+        #already logged in, show the questions again without asking the backend
+        update.message.reply_text('Welcome back! Please select your query:', reply_markup=QUERY_KEYBOARD)
+        logger.info('Login resumed by %s', LazyUser(update.message.from_user),
+                    extra={'event': 'login_resumed', 'handler': 'start', 'participantCode': context.user_data["participantCode"]})
+        return ConversationHandler.END
+    return begin_login(update, context, 'start')
+
+#/login handler
+@metrics.instrument('login')
+@with_typing
+def login(update, context):
+    """Log in again with a participant code when the command /login is issued."""
+    return begin_login(update, context, 'login')
+
+# Login attempts are limited per Telegram id to LOGIN_BURST at once, refilled at LOGIN_RATE per minute.
+# Ids that the backend reported as blocked (HTTP 423) are answered locally for BLOCKED_TTL seconds
+loginLimiter = RateLimiter(rate=float(os.environ.get("LOGIN_RATE", "5"))/60, capacity=int(os.environ.get("LOGIN_BURST", "5")))
+blockedAccounts = TTLCache(maxsize=10000, ttl=int(os.environ.get("BLOCKED_TTL", "900")))
+
+BLOCKED_REPLY = "Sorry, your account has been blocked from using NamjaNinjaBot due to repeated failed login attempts. Please type /feedback to submit a request for the account to be unblocked if you are a legitimate NDP 2022 SGS participant"
+
+#checks login attempts from blocked or rate limited users, which are answered without asking the backend
+#returns the (next conversation state, reply) to use instead of the backend, or None
+def login_guard(telegramid):
+    if blockedAccounts.get(telegramid) is not None:
+        logger.info('Blocked account (cached): %s', telegramid, extra={'event': 'login_blocked', 'handler': 'login_step'})
+        return ConversationHandler.END, BLOCKED_REPLY
+    if not loginLimiter.allow(telegramid):
+        logger.warning('%s is sending login attempts too quickly', telegramid, extra={'event': 'login_rate_limited', 'handler': 'login_step'})
+        return LOGIN_STEP, 'Too many login attempts. Please wait a minute and try again:'
+    return None
+
+#number of login requests answered locally instead of by the backend
+def login_guard_stats():
+    return {
+        'blocked_cached': blockedAccounts.hits,
+        'rate_limited': loginLimiter.limited,
+        'backend_calls_avoided': blockedAccounts.hits+loginLimiter.limited,
+    }
+
+#participant code, telegram id and form data for the login request
+def login_request(update):
     if update.message.from_user.username==None:
         username=""
     else:
@@ -50,390 +469,310 @@ def login_step(update, context):
         lastname=""
     else:
         lastname=update.message.from_user.last_name
-    context.bot.send_chat_action(chat_id=update.message.chat.id, action=ChatAction.TYPING, timeout=None)
-    if update.message.text:
-        partCode=update.message.text.capitalize().strip()
-        telegramid=str(update.message.from_user.id)
-        url = baseurl+'user/'+partCode+'/'+telegramid+'/'
-        data = {
-            'telegramId':telegramid,
-            'participantCode':partCode,
-            'username':username,
-            'firstname': update.message.from_user.first_name,
-            'lastname': lastname
-        }
-        response = requests.post(url, data = data)
-        if response.status_code == 200:
-            data = response.text
-            parse_json = json.loads(data)
-            if parse_json['token']!="":
-                #successful login
-                #got user's session token and participant code. enable user to use the service
-                context.user_data["token"] = parse_json['token']
-                context.user_data["participantCode"] = partCode
-                #show questions
-                keyboard = [
-                    [KeyboardButton("Next NDP activity?")],
-                    [KeyboardButton("Show all NDP activities")],
-                    [KeyboardButton("Zoom link?")],
-                    [KeyboardButton("Countdown")],
-                    [KeyboardButton("Daily encouragement")],
-                    [KeyboardButton("Last updated?")],
-                ]
-                reply_markup = ReplyKeyboardMarkup(keyboard)
-                context.user_data.pop('cancelCmd', None)
-                context.user_data.pop('loginTriesNonText', None)
-                logging.info('Successful login by '+telegramid+' ('+username+", "+ partCode+')')
-                update.message.reply_text('Please select your query:', reply_markup=reply_markup)
-                return ConversationHandler.END
-            else:
-                #failed login
-                if parse_json['loginAttempts']>=3:
-                    update.message.reply_text('You can type /cancel to exit')
-                    logging.warning(telegramid+' ('+username+') failed to login '+str(parse_json['loginAttempts'])+' times')
-                update.message.reply_text('Invalid participant code. Please try again:')
-                return LOGIN_STEP
-        elif response.status_code == 423:
-            #Account blocked
-            logging.info('Blocked account: '+telegramid+' ('+username+", "+ partCode+')')
-            update.message.reply_text("Sorry, your account has been blocked from using NamjaNinjaBot due to repeated failed login attempts. Please type /feedback to submit a request for the account to be unblocked if you are a legitimate NDP 2022 SGS participant")
-            return ConversationHandler.END
-        else:
-            #bad requests
+    partCode=update.message.text.capitalize().strip()
+    telegramid=str(update.message.from_user.id)
+    data = {
+        'telegramId':telegramid,
+        'participantCode':partCode,
+        'username':username,
+        'firstname': update.message.from_user.first_name,
+        'lastname': lastname
+    }
+    return partCode, telegramid, data
+
+#handles the backend's answer to the login request, returns the next conversation state
+def login_result(update, context, partCode, telegramid, response, started):
+    user=LazyUser(update.message.from_user)
+    if response is not None and response.status_code == 200:
+        data = response.text
+        parse_json = json.loads(data)
+        if parse_json['token']!="":
+            #successful login
+            #got user's session token and participant code. enable user to use the service
+            context.user_data["token"] = parse_json['token']
+            context.user_data["participantCode"] = partCode
+            context.user_data["loginTime"] = time.time()
             context.user_data.pop('cancelCmd', None)
             context.user_data.pop('loginTriesNonText', None)
-            logging.error('Unsuccessful login by '+telegramid+' ('+username+", "+ partCode+')')
-            update.message.reply_text('Unable to process request at this time. Please try again later')
+            blockedAccounts.pop(telegramid)
+            logger.info('Successful login by %s: %s', user, partCode,
+                        extra={'event': 'login_success', 'handler': 'login_step', 'participantCode': partCode, 'latency': elapsed_ms(started)})
+            #show questions
+            update.message.reply_text('Please select your query:', reply_markup=QUERY_KEYBOARD)
             return ConversationHandler.END
+        else:
+            #failed login
+            if parse_json['loginAttempts']>=3:
+                update.message.reply_text('You can type /cancel to exit')
+                logger.warning('%s failed to login %s times', user, parse_json['loginAttempts'],
+                               extra={'event': 'login_failed', 'handler': 'login_step', 'latency': elapsed_ms(started)})
+            update.message.reply_text('Invalid participant code. Please try again:')
+            return LOGIN_STEP
+    elif response is not None and response.status_code == 423:
+        #Account blocked
+        logger.info('Blocked account: %s: %s', user, partCode,
+                    extra={'event': 'login_blocked', 'handler': 'login_step', 'participantCode': partCode, 'latency': elapsed_ms(started)})
+        blockedAccounts.set(telegramid, True)
+        update.message.reply_text(BLOCKED_REPLY)
+        return ConversationHandler.END
     else:
-        #Non-text input during login
-        if context.user_data["loginTriesNonText"]>=3:
-            update.message.reply_text('You can type /cancel to exit')
-        context.user_data["loginTriesNonText"]=context.user_data["loginTriesNonText"]+1
-        logging.warning(str(update.message.from_user.id)+' ('+username+') gave non-text reply on login')
-        update.message.reply_text('Input should be a text message. Please try again')
+        #bad requests
+        context.user_data.pop('cancelCmd', None)
+        context.user_data.pop('loginTriesNonText', None)
+        logger.error('Unsuccessful login by %s: %s', user, partCode,
+                     extra={'event': 'login_error', 'handler': 'login_step', 'participantCode': partCode, 'latency': elapsed_ms(started)})
+        update.message.reply_text('Unable to process request at this time. Please try again later')
+        return ConversationHandler.END
+
+#Non-text input during login
+def login_non_text(update, context):
+    if context.user_data["loginTriesNonText"]>=3:
+        update.message.reply_text('You can type /cancel to exit')
+    context.user_data["loginTriesNonText"]=context.user_data["loginTriesNonText"]+1
+    logger.warning('%s gave non-text reply on login', LazyUser(update.message.from_user), extra={'event': 'login_non_text', 'handler': 'login_step'})
+    update.message.reply_text('Input should be a text message. Please try again')
+
+#start: login
+@metrics.instrument('login_step')
+@with_typing(slow=True)
+def login_step(update, context):
+    started = time.monotonic()
+    if update.message.text:
+        partCode, telegramid, data = login_request(update)
+        guarded = login_guard(telegramid)
+        if guarded is not None:
+            update.message.reply_text(guarded[1])
+            return guarded[0]
+        with backend_wait():
+            response = backend.post('user', [partCode, telegramid], data = data)
+        return login_result(update, context, partCode, telegramid, response, started)
+    else:
+        login_non_text(update, context)
+
+#start: login, for the async engine
+@metrics.instrument('login_step')
+@with_typing_async
+async def login_step_async(update, context):
+    started = time.monotonic()
+    if update.message.text:
+        partCode, telegramid, data = login_request(update)
+        guarded = login_guard(telegramid)
+        if guarded is not None:
+            await engine.to_thread(update.message.reply_text, guarded[1])
+            return guarded[0]
+        with backend_wait():
+            response = await asyncBackend.post('user', [partCode, telegramid], data = data)
+        return await engine.to_thread(login_result, update, context, partCode, telegramid, response, started)
+    else:
+        await engine.to_thread(login_non_text, update, context)
+
+#logs the command issued by the user
+def log_command(update, command):
+    logger.info('Command issued by %s: %s', LazyUser(update.message.from_user), command, extra={'event': 'command', 'handler': command})
 
 #/help handler
+@metrics.instrument('help')
+@with_typing
 def help(update, context):
-    context.bot.send_chat_action(chat_id=update.message.chat.id, action=ChatAction.TYPING, timeout=None)
-    if update.message.from_user.username==None:
-        username=""
-        logging.info('Command issued by '+update.message.from_user.first_name+' ('+str(update.message.from_user.id)+'): help')
-    else:
-        username=update.message.from_user.username
-        logging.info('Command issued by '+update.message.from_user.first_name+' ('+username+', '+str(update.message.from_user.id)+'): help')
+    log_command(update, 'help')
     """Send a message when the command /help is issued."""
-    update.message.reply_text('Hi '+update.message.from_user.first_name+'! I am NamjaNinja! I can assist you on your SGS NDP 2022 journey!\n\nSend the following commands to get started:\n/start - Lists all the queries I can help you with\n/about - Learn more about me\n/feedback - Tell me how I can improve\n/help - Describes how to use me\n/share - Share me with your fellow participants')
+    update.message.reply_text('Hi '+update.message.from_user.first_name+'! I am NamjaNinja! I can assist you on your SGS NDP 2022 journey!\n\nSend the following commands to get started:\n/start - Lists all the queries I can help you with\n/login - Log in again with another participant code\n/about - Learn more about me\n/feedback - Tell me how I can improve\n/help - Describes how to use me\n/share - Share me with your fellow participants')
 
 #/share handler
+@metrics.instrument('share')
+@with_typing
 def share(update, context):
-    context.bot.send_chat_action(chat_id=update.message.chat.id, action=ChatAction.TYPING, timeout=None)
-    if update.message.from_user.username==None:
-        username=""
-        logging.info('Command issued by '+update.message.from_user.first_name+' ('+str(update.message.from_user.id)+'): share')
-    else:
-        username=update.message.from_user.username
-        logging.info('Command issued by '+update.message.from_user.first_name+' ('+username+', '+str(update.message.from_user.id)+'): share')
+    log_command(update, 'share')
     """Send a message when the command /share is issued."""
     update.message.reply_text('Hello! I am NamjaNinjaBot, a Telegram Bot that can provide training information and encouragement to SGS NDP 2022 participants:\nhttps://t.me/NamjaNinjabot')
 
 #/about handler
+@metrics.instrument('about')
+@with_typing
 def about(update, context):
-    context.bot.send_chat_action(chat_id=update.message.chat.id, action=ChatAction.TYPING, timeout=None)
-    if update.message.from_user.username==None:
-        username=""
-        logging.info('Command issued by '+update.message.from_user.first_name+' ('+str(update.message.from_user.id)+'): about')
-    else:
-        username=update.message.from_user.username
-        logging.info('Command issued by '+update.message.from_user.first_name+' ('+username+', '+str(update.message.from_user.id)+'): about')
+    log_command(update, 'about')
     """Send a message when the command /about is issued."""
     update.message.reply_text('*About*\nNamjaNinjaBot is a Telegram bot that is aimed at allowing Soka Gakkai Singapore (SGS) NDP 2022 participants to obtain NDP training and meeting details easily and quickly. Participants can also get daily encouragements through the bot\n\n*Disclaimer*\nThis bot was created in good faith by one of the participants to be a handy companion to the participants and should strictly be used for such purposes only. By using NamjaNinjaBot, you agree to the collection of user data that will only be used for NamjaNinjaBot performance monitoring and to ensure that the bot is used for its intended purpose only. Thank you for your understanding', parse_mode='Markdown')
 
-#determine reply after query chosen, ensures participantCode and session token is available
-def reply(update, context):
-    context.bot.send_chat_action(chat_id=update.message.chat.id, action=ChatAction.TYPING, timeout=None)
-    if 'participantCode' in context.user_data and context.user_data["participantCode"]!="" and 'token' in context.user_data and context.user_data["token"]!="":
-        if update.message.text:
-            if update.message.from_user.username==None:
-                username=""
-            else:
-                username=update.message.from_user.username
-            telegramid=str(update.message.from_user.id)
-            urlDets = baseurl+'details/'+context.user_data["participantCode"]+'/'+telegramid+"/1/"
-            urlTrainings = baseurl+'training/'+context.user_data["participantCode"]+'/'+telegramid+"/1/"
-            headers = {
-                "token":context.user_data["token"]
-            }
-            if update.message.text=="Next NDP activity?":
-                if update.message.from_user.username==None:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+telegramid+'): Next NDP activity?')
-                else:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+username+', '+telegramid+'): Next NDP activity?')
-                # Find next NDP activity
-                responseDets=requests.get(urlDets, headers=headers)
-                responseTraining=requests.get(urlTrainings, headers=headers)
-                if responseDets.status_code == 200 and responseTraining.status_code == 200:
-                    data = responseDets.text
-                    dataDets = json.loads(data)
-                    data = responseTraining.text
-                    dataTrain = json.loads(data)
-
-                    today = datetime.now(ZoneInfo('Singapore'))
-                    daysdiff=""
-                    smallestDateIndex=""
-                    ndpInt=""
-                    ndpDatetime=""
-                    postcelebrationInt=""
-                    ndpPostCelebDatetime=""
-                    i=0
-                    for item in dataTrain:
-                        if re.search("^NDP [0-9][0-9][0-9][0-9] Post Celebration$", item["title"]):
-                            postcelebrationInt = i
-                            if item["datetime_end"]!="TBA":
-                                ndpPostCelebDatetime=datetime.strptime(item["datetime_end"], '%Y-%m-%dT%H:%M:%S')
-                                ndpPostCelebDatetime=ndpPostCelebDatetime.replace(tzinfo=ZoneInfo('Singapore'))
-                        if item["datetime_end"]!="TBA":
-                            datetimeInterator=datetime.strptime(item["datetime_end"], '%Y-%m-%dT%H:%M:%S')
-                            datetimeInterator=datetimeInterator.replace(tzinfo=ZoneInfo('Singapore'))
-                            # If NDP, save details for use later
-                            if datetimeInterator.day == 9 and datetimeInterator.month == 8:
-                                ndpInt = i
-                                ndpDatetime = datetimeInterator
-                            if datetimeInterator > today:
-                                difftemp=datetimeInterator-today
-                                if daysdiff == "" or difftemp < daysdiff:
-                                    smallestDateIndex=i
-                                    daysdiff=difftemp
-                        i=i+1
-                    # Check if pass 9 Aug
-                    if today > ndpDatetime and dataTrain[postcelebrationInt]["datetime_end"]=="TBA":
-                        reply = "Hope NamjaNinjaBot was useful to you in some way or another. The NDP Post Celebration Details have not been updated or released. This will be updated in due time. See you at the post celebrations and congratulations on completing NDP 2022!"
-                        logging.info(context.user_data["participantCode"]+': Successfully answered question')
-                        update.message.reply_text(reply, parse_mode='Markdown')
-                    # Check if pass post celebrations
-                    elif today > ndpPostCelebDatetime and dataTrain[postcelebrationInt]["datetime_end"]!="TBA":
-                        reply = "NDP 2022 has come to an end. Thank you for using NamjaNinjaBot and hope it has helped you on this journey. May you continue to achieve more victories in the future! NamjaNinjaBot signing off~"
-                        logging.info(context.user_data["participantCode"]+': Successfully answered question')
-                        update.message.reply_text(reply, parse_mode='Markdown')
-                    else:
-                        # Format Date to Display
-                        dateToFormat=datetime.strptime(dataTrain[smallestDateIndex]["datetime_start"], '%Y-%m-%dT%H:%M:%S')
-                        dateToFormatEnd=datetime.strptime(dataTrain[smallestDateIndex]["datetime_end"], '%Y-%m-%dT%H:%M:%S')
-                        dateToFormat=dateToFormat.replace(tzinfo=ZoneInfo('Singapore'))
-                        dateToFormatEnd=dateToFormatEnd.replace(tzinfo=ZoneInfo('Singapore'))
-                        # Format reply
-                        reply="*"+dataTrain[smallestDateIndex]["title"]+"*\n"+"📍: "+dataTrain[smallestDateIndex]["location"]+"\n"+"📅:"+dateToFormat.strftime(" %d %b %Y, %a").replace(' 0', ' ')+"\n"+"🕓:"+dateToFormat.strftime(" %I:%M%p -").replace(' 0', ' ') + dateToFormatEnd.strftime(" %I:%M%p").replace(' 0', ' ')
-                        if dataTrain[smallestDateIndex]["Note"]!="Nil":
-                            reply=reply+"\n"+"📝: "+dataTrain[smallestDateIndex]["Note"]
-                        if dataTrain[smallestDateIndex]["location"]=="Zoom":
-                            reply=reply+"\n"+"Zoom Link: "+dataDets["zoomlink"]
-                        if re.match("^NDP (Training[a-zA-Z1-4]*|[NC][ER] [1-3]|Preview|2022)", dataTrain[smallestDateIndex]["title"]):
-                            reply=reply+"\n\n"+"Attire: "
-                            for i in range(0, len(dataDets["training_attire"])):
-                                reply=reply+"\n    "+"- "+dataDets["training_attire"][i]
-                            if dataTrain[smallestDateIndex]["location"]=="Floating Platform" or dataTrain[smallestDateIndex]["location"]=="Senja Soka Centre":
-                                reply=reply+"\n"+"Things to Bring: "
-                                for i in range(0, len(dataDets["training_bring"])):
-                                    reply=reply+"\n    "+str(i+1)+") "+dataDets["training_bring"][i]
-                                if re.match("^NDP ([NC][ER] [1-3]|Preview|2022)", dataTrain[smallestDateIndex]["title"]):
-                                    reply=reply+"\n    "+str(i+2)+") "+"Costume"
-                        logging.info(context.user_data["participantCode"]+': Successfully answered question')
-                        update.message.reply_text(reply, parse_mode='Markdown')
-                else:
-                    logging.error(context.user_data["participantCode"]+': Failed to get DB data')
-                    update.message.reply_text("Unable to get next training details. Please try again later or type /start to reset")
+#logs the query asked by the user
+def log_question(update, context, query):
+    logger.info('Question asked by %s: %s', LazyUser(update.message.from_user), query,
+                extra={'event': 'question', 'handler': 'reply', 'participantCode': context.user_data.get("participantCode")})
 
-            elif update.message.text=="Show all NDP activities":
-                if update.message.from_user.username==None:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+telegramid+'): Show all NDP activities')
-                else:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+username+', '+telegramid+'): Show all NDP activities')
-                responseTraining=requests.get(urlTrainings, headers=headers)
-                if responseTraining.status_code == 200:
-                    data = responseTraining.text
-                    dataTrain = json.loads(data)
-
-                    today = datetime.now(ZoneInfo('Singapore'))
-                    remainingTrain=[]
-                    tbaEndTrain=[]
-                    for item in dataTrain:
-                        if item["datetime_end"]!="TBA":
-                            datetimeInterator=datetime.strptime(item["datetime_end"], '%Y-%m-%dT%H:%M:%S')
-                            datetimeInterator=datetimeInterator.replace(tzinfo=ZoneInfo('Singapore'))
-                            if item["datetime_start"]!="TBA":
-                                datetimeStart=datetime.strptime(item["datetime_start"], '%Y-%m-%dT%H:%M:%S')
-                                item["startDate"]= datetimeStart
-                            elif item["datetime_start"]=="TBA":
-                                item["startDate"]= "TBA"
-                            if datetimeInterator > today:
-                                item["endDate"]= datetimeInterator
-                                remainingTrain.append(item)
-                        elif item["datetime_end"]=="TBA":
-                            tbaEndTrain.append(item)
-                    #sort by date for activity with end datetime then add TBA trainings at the back
-                    sortedRemainingTrain = sorted(remainingTrain, key=lambda d: d['endDate'])
-                    sortedRemainingTrain=sortedRemainingTrain+tbaEndTrain
-                    reply="*NDP Activity Schedule*"
-                    if len(sortedRemainingTrain)==0:
-                        reply="NDP 2022 has come to an end. Thank you for using NamjaNinjaBot and hope it has helped you on this journey. May you continue to achieve more victories in the future! NamjaNinjaBot signing off~"
-                    else:
-                        # Format reply
-                        i=1
-                        for activity in sortedRemainingTrain:
-                            reply=reply+"\n"+str(i)+") "+activity["title"]+": "
-                            if activity["datetime_end"]!="TBA":
-                                reply=reply+activity["endDate"].strftime(" %d %b %Y (%a)").replace(' 0', ' ')
-                            else:
-                                reply=reply + "TBA"
-                            if activity["datetime_start"]!="TBA":
-                                reply=reply+", "+activity["startDate"].strftime(" %I:%M%p -").replace(' 0', ' ')
-                            else:
-                                reply=reply+", TBA - "
-                            if activity["datetime_end"]!="TBA":
-                                reply=reply+activity["endDate"].strftime(" %I:%M%p").replace(' 0', ' ')
-                            else:
-                                reply=reply+"TBA"
-                            reply=reply+" @ "+activity["location"]
-                            i=i+1
-                        
-                    logging.info(context.user_data["participantCode"]+': Successfully answered question')
-                    update.message.reply_text(reply, parse_mode='Markdown')
-                else:
-                    logging.error(context.user_data["participantCode"]+': Failed to get DB data')
-                    update.message.reply_text("Unable to get training details. Please try again later or type /start to reset")
-                    
-            elif update.message.text=="Last updated?":
-                #returns when training schedule last updated
-                if update.message.from_user.username==None:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+telegramid+'): Last updated?')
-                else:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+username+', '+telegramid+'): Last updated?')
-                response=requests.get(urlDets, headers=headers)
-                if response.status_code == 200:
-                    data = response.text
-                    parse_json = json.loads(data)
-                    logging.info(context.user_data["participantCode"]+': Successfully answered question')
-                    update.message.reply_text("The training schedule for the bot was last updated on: "+parse_json["lastupdate"])
-                else:
-                    logging.error(context.user_data["participantCode"]+': Failed to get DB data')
-                    update.message.reply_text("Unable to get training schedule last updated details. Please try again later or type /start to reset")
+#countdown string like "3 Days, 4h 5m 6s" to a datetime in the future
+def format_countdown(countdown):
+    seconds = countdown.total_seconds()
+    hours = str(seconds // 3600 % 24).replace(".0","")
+    minutes = str((seconds % 3600) // 60).replace(".0","")
+    seconds = str(math.floor(seconds % 60))
+    if countdown.days==1:
+        dayStr="Day"
+    else:
+        dayStr="Days"
+    return str(countdown.days)+" "+dayStr+", "+hours+"h "+minutes+"m "+seconds+"s"
 
-            elif update.message.text=="Zoom link?":
-                #returns zoom link used for meetings
-                if update.message.from_user.username==None:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+telegramid+'): Zoom link?')
-                else:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+username+', '+telegramid+'): Zoom link?')
-                response=requests.get(urlDets, headers=headers)
-                if response.status_code == 200:
-                    data = response.text
-                    parse_json = json.loads(data)
-                    logging.info(context.user_data["participantCode"]+': Successfully answered question')
-                    update.message.reply_text("Zoom Link: "+parse_json["zoomlink"])
-                else:
-                    logging.error(context.user_data["participantCode"]+': Failed to get DB data')
-                    update.message.reply_text("Unable to get zoom link. Please try again later or type /start to reset")
+# Answers to the keyboard queries. Each takes the backend data it needs and the current time,
+# and returns the reply text and its parse mode, followed by its reply markup if it has one
+def answer_next_activity(data, today):
+    schedule, dataDets = data['training'], data['details']
+    reply = cached_reply(('next', schedule.version, next_activity_details_version(dataDets)), schedule, today,
+                         lambda: render_next_activity(schedule, dataDets, today))
+    return reply, 'Markdown'
 
-            elif update.message.text=="Countdown":
-                #returns countdown to next NDP activity and NDP 2022
-                if update.message.from_user.username==None:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+telegramid+'): Countdown')
-                else:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+username+', '+telegramid+'): Countdown')
-                # Find next NDP activity
-                responseTraining=requests.get(urlTrainings, headers=headers)
-                if responseTraining.status_code == 200:
-                    data = responseTraining.text
-                    dataTrain = json.loads(data)
-                    today = datetime.now(ZoneInfo('Singapore'))
-                    daysdiff=""
-                    smallestDateIndex=""
-                    i=0
-                    for item in dataTrain:
-                        if item["datetime_end"]!="TBA":
-                            datetimeInterator=datetime.strptime(item["datetime_end"], '%Y-%m-%dT%H:%M:%S')
-                            datetimeInterator=datetimeInterator.replace(tzinfo=ZoneInfo('Singapore'))
-                            if datetimeInterator > today:
-                                difftemp=datetimeInterator-today
-                                if daysdiff == "" or difftemp < daysdiff:
-                                    smallestDateIndex=i
-                                    daysdiff=difftemp
-                        i=i+1
-                    if isinstance(smallestDateIndex, int):
-                        dateToFormat=datetime.strptime(dataTrain[smallestDateIndex]["datetime_start"], '%Y-%m-%dT%H:%M:%S')
-                        dateToFormat=dateToFormat.replace(tzinfo=ZoneInfo('Singapore'))
-                        countdownToNext=dateToFormat-today
-                        if dateToFormat > today:
-                            seconds = countdownToNext.total_seconds()
-                            hours = str(seconds // 3600 % 24).replace(".0","")
-                            minutes = str((seconds % 3600) // 60).replace(".0","")
-                            seconds = str(math.floor(seconds % 60))
-                            if countdownToNext.days==1:
-                                dayStr="Day"
-                            else:
-                                dayStr="Days"
-                            countdownToNextStr=str(countdownToNext.days)+" "+dayStr+", "+hours+"h "+minutes+"m "+seconds+"s"
-                    else:
-                        countdownToNextStr="Countdown has ended"
-                    NDPDate=datetime(2022, 8, 9)
-                    NDPDate=NDPDate.replace(tzinfo=ZoneInfo('Singapore'))
-                    countdownToNDP=NDPDate-today
-                    if NDPDate > today:
-                        seconds = countdownToNDP.total_seconds()
-                        hours = str(seconds // 3600 % 24).replace(".0","")
-                        minutes = str((seconds % 3600) // 60).replace(".0","")
-                        seconds = str(math.floor(seconds % 60))
-                        if countdownToNDP.days==1:
-                            dayStr="Day"
-                        else:
-                            dayStr="Days"
-                        countdownToNDPStr=str(countdownToNDP.days)+" "+dayStr+", "+hours+"h "+minutes+"m "+seconds+"s"
-                    else:
-                        countdownToNDPStr="Countdown has ended"
-                    logging.info(context.user_data["participantCode"]+': Successfully answered question')
-                    update.message.reply_text('🎉 *Countdown* 🎉\nNext NDP activity: '+countdownToNextStr+'\nNDP 2022: '+countdownToNDPStr, parse_mode='Markdown')
-                else:
-                    logging.error(context.user_data["participantCode"]+': Failed to get DB data')
-                    update.message.reply_text("Unable to get countdown. Please try again later or type /start to reset")
+def all_activity_pages(schedule, today):
+    return cached_reply(('all', schedule.version), schedule, today,
+                        lambda: render_all_activities(schedule, today))
 
-            elif update.message.text=="Daily encouragement":
-                #returns daily encouragement
-                if update.message.from_user.username==None:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+telegramid+'): Daily encouragement')
-                else:
-                    logging.info('Question asked by '+update.message.from_user.first_name+' ('+username+', '+telegramid+'): Daily encouragement')
-                link="https://www.sokaglobal.org/resources/daily-encouragement/"
-                today = datetime.now(ZoneInfo('Singapore'))
-                month=today.strftime("%B").lower()
-                link = link + month + "-" + str(today.day) + ".html"
-                logging.info(context.user_data["participantCode"]+': Successfully answered question')
-                update.message.reply_text(link)  
-            else:
-                update.message.reply_text('Please select a valid question or type /help')
+def answer_all_activities(data, today):
+    schedule = data['training']
+    pages = all_activity_pages(schedule, today)
+    return pages[0], 'Markdown', page_keyboard(schedule.version, 0, len(pages))
+
+def answer_last_updated(data, today):
+    #returns when training schedule last updated
+    return "The training schedule for the bot was last updated on: "+data['details']["lastupdate"], None
+
+def answer_zoom_link(data, today):
+    #returns zoom link used for meetings
+    return "Zoom Link: "+data['details']["zoomlink"], None
+
+def answer_countdown(data, today):
+    #returns countdown to next NDP activity and NDP 2022
+    nextActivity=data['training'].next_activity(today)
+    countdownToNextStr="Countdown has ended"
+    if nextActivity is not None and nextActivity.start is not None:
+        if nextActivity.start > today:
+            countdownToNextStr=format_countdown(nextActivity.start-today)
         else:
-            update.message.reply_text('Please select a valid question or type /help')
+            countdownToNextStr="Happening now"
+    NDPDate=datetime(2022, 8, 9)
+    NDPDate=NDPDate.replace(tzinfo=SGT)
+    if NDPDate > today:
+        countdownToNDPStr=format_countdown(NDPDate-today)
     else:
-        update.message.reply_text('Please type /start first')
+        countdownToNDPStr="Countdown has ended"
+    return '🎉 *Countdown* 🎉\nNext NDP activity: '+countdownToNextStr+'\nNDP 2022: '+countdownToNDPStr, 'Markdown'
+
+def answer_daily_encouragement(data, today):
+    #returns daily encouragement
+    link="https://www.sokaglobal.org/resources/daily-encouragement/"
+    month=today.strftime("%B").lower()
+    link = link + month + "-" + str(today.day) + ".html"
+    return link, None
+
+# query -> (backend data needed, answer function, reply when the backend data is unavailable)
+QUERIES = {
+    "Next NDP activity?": (('details', 'training'), answer_next_activity, "Unable to get next training details. Please try again later or type /login to log in again"),
+    "Show all NDP activities": (('training',), answer_all_activities, "Unable to get training details. Please try again later or type /login to log in again"),
+    "Zoom link?": (('details',), answer_zoom_link, "Unable to get zoom link. Please try again later or type /login to log in again"),
+    "Countdown": (('training',), answer_countdown, "Unable to get countdown. Please try again later or type /login to log in again"),
+    "Daily encouragement": ((), answer_daily_encouragement, None),
+    "Last updated?": (('details',), answer_last_updated, "Unable to get training schedule last updated details. Please try again later or type /login to log in again"),
+}
+
+#query label of the reply metrics, anything that is not one of the QUERIES is counted together
+def query_label(update):
+    text = update.message.text if update.message else None
+    return text if text in QUERIES else 'other'
+
+#whether the user_data of a user holds a participantCode and session token
+def is_logged_in(user_data):
+    return 'participantCode' in user_data and user_data["participantCode"]!="" and 'token' in user_data and user_data["token"]!=""
+
+#ensures participantCode and session token is available and the query is valid. Returns the reply to send otherwise
+def reply_precheck(update, context):
+    if login_valid(context.user_data):
+        if update.message.text and update.message.text in QUERIES:
+            return None
+        return 'Please select a valid question or type /help'
+    return 'Please type /start first'
+
+#sends the answer to the query given the backend data fetched for it
+def send_answer(update, context, query, data, started):
+    needs, answer, failure = QUERIES[query]
+    partCode = context.user_data["participantCode"]
+    if None in data.values():
+        logger.error('%s: Failed to get DB data', partCode,
+                     extra={'event': 'backend_error', 'handler': 'reply', 'participantCode': partCode, 'latency': elapsed_ms(started)})
+        update.message.reply_text(failure)
+    else:
+        reply, parse_mode, *markup = answer(data, datetime.now(SGT))
+        update.message.reply_text(reply, parse_mode=parse_mode, reply_markup=markup[0] if markup else None)
+        logger.info('%s: Successfully answered question', partCode,
+                    extra={'event': 'answered', 'handler': 'reply', 'participantCode': partCode, 'latency': elapsed_ms(started)})
+
+#determine reply after query chosen
+@metrics.instrument('reply', query=query_label)
+@with_typing(slow=True)
+def reply(update, context):
+    started = time.monotonic()
+    precheck = reply_precheck(update, context)
+    if precheck is not None:
+        update.message.reply_text(precheck)
+        return
+    query = update.message.text
+    log_question(update, context, query)
+    telegramid=str(update.message.from_user.id)
+    needs = QUERIES[query][0]
+    data = {endpoint: get_backend_data(endpoint, context.user_data["participantCode"], telegramid, context.user_data["token"]) for endpoint in needs}
+    send_answer(update, context, query, data, started)
+
+#reply for the async engine, fetches all the backend data the query needs concurrently
+@metrics.instrument('reply', query=query_label)
+@with_typing_async
+async def reply_async(update, context):
+    started = time.monotonic()
+    precheck = reply_precheck(update, context)
+    if precheck is not None:
+        await engine.to_thread(update.message.reply_text, precheck)
+        return
+    query = update.message.text
+    log_question(update, context, query)
+    telegramid=str(update.message.from_user.id)
+    needs = QUERIES[query][0]
+    results = await asyncio.gather(*(get_backend_data_async(endpoint, context.user_data["participantCode"], telegramid, context.user_data["token"]) for endpoint in needs))
+    await engine.to_thread(send_answer, update, context, query, dict(zip(needs, results)), started)
+
+#prev/next buttons of "Show all NDP activities", shows the page in the same message
+@metrics.instrument('all_activities_page')
+def show_all_page(update, context):
+    query = update.callback_query
+    if not login_valid(context.user_data):
+        query.answer('Please type /start first')
+        return
+    page = int(query.data.split()[2])
+    telegramid = str(query.from_user.id)
+    schedule = get_backend_data('training', context.user_data["participantCode"], telegramid, context.user_data["token"])
+    if schedule is None:
+        query.answer('Unable to get training details. Please try again later')
+        return
+    #the schedule may have changed since the buttons were sent, pages of the current one are shown
+    pages = all_activity_pages(schedule, datetime.now(SGT))
+    page = min(page, len(pages)-1)
+    query.answer()
+    try:
+        query.edit_message_text(pages[page], parse_mode='Markdown', reply_markup=page_keyboard(schedule.version, page, len(pages)))
+    except BadRequest as e:
+        #pressed twice, the message already shows the page
+        if 'not modified' not in str(e):
+            raise
+    logger.info('%s: Showed page %d of all activities', context.user_data["participantCode"], page+1,
+                extra={'event': 'page', 'handler': 'show_all_page', 'participantCode': context.user_data["participantCode"]})
 
 #/feedback handler
+@metrics.instrument('feedback')
+@with_typing
 def feedback(update, context):
-    context.bot.send_chat_action(chat_id=update.message.chat.id, action=ChatAction.TYPING, timeout=None)
     context.user_data["cancelCmd"]="feedback"
     context.user_data["feedbackTriesNonText"]=0
-    if update.message.from_user.username==None:
-        username=""
-        logging.info('Command issued by '+update.message.from_user.first_name+' ('+str(update.message.from_user.id)+'): feedback')
-    else:
-        username=update.message.from_user.username
-        logging.info('Command issued by '+update.message.from_user.first_name+' ('+username+', '+str(update.message.from_user.id)+'): feedback')
+    log_command(update, 'feedback')
     """Send a message when the command /feedback is issued."""
     update.message.reply_text('NamjaNinjaBot will listen to all feedback. Please follow the steps to submit one. If you decided to change your mind, just type /cancel')
     update.message.reply_text("Please type your feedback:")
     return FIRST_STEP
 
-#feedback submission
-def first_step(update, context):
-    context.bot.send_chat_action(chat_id=update.message.chat.id, action=ChatAction.TYPING, timeout=None)
+#validates the feedback. Returns the feedback url parts and form data to submit, or None after telling the user what is wrong
+def feedback_request(update, context):
     telegramid=str(update.message.from_user.id)
     if update.message.from_user.last_name==None:
         lastname=""
@@ -445,7 +784,7 @@ def first_step(update, context):
         username=update.message.from_user.username
     if update.message.text:
         #ensures feedback is not a defined query
-        if update.message.text !="Next NDP activity?" and  update.message.text !="Zoom link?" and update.message.text != "Countdown" and update.message.text !="Daily encouragement" and update.message.text !="Last updated?" and update.message.text !="Show all NDP activities": 
+        if update.message.text not in QUERIES:
             lengthOfFeedback=len(update.message.text)
             #ensures feedback is not too long or short
             if lengthOfFeedback>5:
@@ -453,10 +792,10 @@ def first_step(update, context):
                     # if logged in
                     if 'participantCode' in context.user_data and context.user_data["participantCode"]!="":
                         partCode=context.user_data["participantCode"]
-                        url=baseurl+'feedback/'+partCode+'/'+telegramid+'/'
+                        urlCode=partCode
                     else:
                         partCode=""
-                        url=baseurl+'feedback/nil/'+telegramid+'/'
+                        urlCode="nil"
                     data = {'telegramId':update.message.from_user.id,
                             'participantCode': partCode,
                             'username':username,
@@ -464,51 +803,75 @@ def first_step(update, context):
                             'lastname': lastname,
                             "feedback": update.message.text
                             }
-                    #submit feedback
-                    response = requests.post(url, data = data)
-                    if response.status_code == 201:
-                        update.message.reply_text("Thank you for your feedback!")
-                        if update.message.from_user.username==None:
-                            logging.info(update.message.from_user.first_name+' ('+telegramid+') successfully submitted feedback')
-                        else:
-                            logging.info(update.message.from_user.first_name+' ('+username+', '+telegramid+') '+'successfully submitted feedback')
-                        context.user_data.pop('cancelCmd', None)
-                        context.user_data.pop('feedbackTriesNonText', None)
-                        return ConversationHandler.END
-                    else:
-                        if update.message.from_user.username==None:
-                            logging.info(update.message.from_user.first_name+' ('+telegramid+') failed to submit feedback')
-                        else:
-                            logging.info(update.message.from_user.first_name+' ('+username+', '+telegramid+') '+'failed to submit feedback')
-                        update.message.reply_text("Failed to submit feedback. Please try again later")
-                        context.user_data.pop('cancelCmd', None)
-                        context.user_data.pop('feedbackTriesNonText', None)
-                        return ConversationHandler.END
+                    return [urlCode, telegramid], data
                 else:
                     update.message.reply_text('Feedback is too long. It should be less than 500 characters. The submitted feedback was '+str(lengthOfFeedback)+' characters long. Please try again')
-                    return FIRST_STEP
             else:
                 update.message.reply_text('Feedback is too short. More details will allow NamjaNinjaBot to understand the issue. Please try again')
-                return FIRST_STEP
         else:
             update.message.reply_text('Feedback cannot be one of the questions that NamjaNinja can help you with. Type /cancel if you want to ask a question instead')
-            return FIRST_STEP
     else:
         if context.user_data["feedbackTriesNonText"]>=3:
             update.message.reply_text('You can type /cancel to exit')
         context.user_data["feedbackTriesNonText"]=context.user_data["feedbackTriesNonText"]+1
-        logging.info(update.message.from_user.first_name+' ('+username+', '+telegramid+') gave non-text reply on feedback')
+        logger.info('%s gave non-text reply on feedback', LazyUser(update.message.from_user), extra={'event': 'feedback_non_text', 'handler': 'first_step'})
         update.message.reply_text('Input should be a text message. Please try again')
+    return None
+
+#submits feedback from the spool
+def submit_feedback(parts, data):
+    return backend.post('feedback', parts, data = data)
+
+#tells the user whether the feedback was spooled or accepted by the backend
+def feedback_result(update, context, submitted, started):
+    fields = {'handler': 'first_step', 'participantCode': context.user_data.get("participantCode"), 'latency': elapsed_ms(started)}
+    if submitted:
+        update.message.reply_text("Thank you for your feedback!")
+        logger.info('%s successfully submitted feedback', LazyUser(update.message.from_user), extra=dict(fields, event='feedback_submitted'))
+    else:
+        logger.info('%s failed to submit feedback', LazyUser(update.message.from_user), extra=dict(fields, event='feedback_failed'))
+        update.message.reply_text("Failed to submit feedback. Please try again later")
+    context.user_data.pop('cancelCmd', None)
+    context.user_data.pop('feedbackTriesNonText', None)
+    return ConversationHandler.END
+
+#feedback submission
+@metrics.instrument('first_step')
+@with_typing(slow=True)
+def first_step(update, context):
+    started = time.monotonic()
+    request = feedback_request(update, context)
+    if request is None:
+        return FIRST_STEP
+    parts, data = request
+    if feedbackSpool is not None and feedbackSpool.append(parts, data):
+        return feedback_result(update, context, True, started)
+    #submit feedback
+    with backend_wait():
+        response = backend.post('feedback', parts, data = data)
+    return feedback_result(update, context, response is not None and response.status_code == 201, started)
+
+#feedback submission, for the async engine
+@metrics.instrument('first_step')
+@with_typing_async
+async def first_step_async(update, context):
+    started = time.monotonic()
+    request = await engine.to_thread(feedback_request, update, context)
+    if request is None:
+        return FIRST_STEP
+    parts, data = request
+    if feedbackSpool is not None and await engine.to_thread(feedbackSpool.append, parts, data):
+        return await engine.to_thread(feedback_result, update, context, True, started)
+    #submit feedback
+    with backend_wait():
+        response = await asyncBackend.post('feedback', parts, data = data)
+    return await engine.to_thread(feedback_result, update, context, response is not None and response.status_code == 201, started)
 
 #/cancel handler
+@metrics.instrument('cancel')
+@with_typing
 def cancel(update, context):
-    context.bot.send_chat_action(chat_id=update.message.chat.id, action=ChatAction.TYPING, timeout=None)
-    if update.message.from_user.username==None:
-        username=""
-        logging.info('Command issued by '+update.message.from_user.first_name+' ('+str(update.message.from_user.id)+'): cancel')
-    else:
-        username=update.message.from_user.username
-        logging.info('Command issued by '+update.message.from_user.first_name+' ('+username+', '+str(update.message.from_user.id)+'): cancel')
+    log_command(update, 'cancel')
     if context.user_data["cancelCmd"]=="feedback":
         context.user_data.pop('feedbackTriesNonText', None)
         update.message.reply_text("Cancelled feedback submission")
@@ -521,51 +884,482 @@ def cancel(update, context):
     context.user_data.pop('cancelCmd', None)
     return ConversationHandler.END
 
+# Reminders pushed to every logged in participant. REMINDER_OFFSETS lists how many minutes before each
+# activity starts the next activity message is sent, DAILY_ENCOURAGEMENT_TIME is when the daily
+# encouragement link is sent (HH:MM, Singapore time). Set either to an empty string to turn it off.
+# The schedule is checked for new or moved activities every REMINDER_REFRESH seconds
+REMINDER_OFFSETS = [int(minutes) for minutes in os.environ.get("REMINDER_OFFSETS", "1440,60").split(",") if minutes.strip()]
+DAILY_ENCOURAGEMENT_TIME = os.environ.get("DAILY_ENCOURAGEMENT_TIME", "07:00")
+REMINDER_REFRESH = int(os.environ.get("REMINDER_REFRESH", "3600"))
+
+#user_data of every user, from the session store when there is one
+def all_user_data(dispatcher):
+    if sessionStore is not None:
+        return sessionStore.users()
+    return dict(dispatcher.user_data)
+
+#telegram ids of the logged in users, their private chat ids are the same. A shard worker only
+#returns the users whose chats are routed to it, the session store holds those of every worker
+def logged_in_users(dispatcher, users=None):
+    if users is None:
+        users = all_user_data(dispatcher)
+    return [user_id for user_id, data in users.items()
+            if is_logged_in(data) and (SHARD_INDEX is None or user_id % SHARDS == SHARD_INDEX)]
+
+#(participantCode, telegramid, token) of the logged in users, for backend requests made outside of a
+#handler. Valid logins first, the most recent first
+def service_credentials(dispatcher):
+    users = all_user_data(dispatcher)
+    candidates = sorted(((login_valid(users[user_id]), users[user_id].get("loginTime") or 0, user_id)
+                         for user_id in logged_in_users(dispatcher, users)), reverse=True)
+    return [(users[user_id]["participantCode"], str(user_id), users[user_id]["token"]) for _, _, user_id in candidates]
+
+#training/details data fetched outside of a handler. Returns None if nobody is logged in or the backend request failed
+def get_shared_data(dispatcher, endpoint):
+    for credentials in service_credentials(dispatcher)[:SCHEDULE_SYNC_TRIES]:
+        data = get_backend_data(endpoint, *credentials)
+        if data is not None:
+            return data
+    return None
+
+#queues one message to every logged in user, behind any replies to users
+def broadcast(context, text, parse_mode=None):
+    name = context.job.name
+    def sent(user_id, future):
+        try:
+            future.result()
+        except Unauthorized:
+            logger.info('%s has blocked the bot, skipping %s', user_id, name, extra={'event': 'broadcast_blocked', 'handler': name})
+        except TelegramError as e:
+            logger.warning('Failed to send %s to %s: %s', name, user_id, e, extra={'event': 'broadcast_error', 'handler': name})
+    users = logged_in_users(context.dispatcher)
+    for user_id in users:
+        future = context.bot.queue_message(user_id, text, parse_mode=parse_mode)
+        future.add_done_callback(functools.partial(sent, user_id))
+    logger.info('Queued %s for %d users', name, len(users), extra={'event': 'broadcast', 'handler': name})
+
+def format_offset(minutes):
+    for unit, length in (("day", 1440), ("hour", 60), ("minute", 1)):
+        if minutes >= length and minutes % length == 0:
+            count = minutes // length
+            return str(count)+" "+unit+("s" if count != 1 else "")
+    return str(minutes)+" minutes"
+
+#fetches training/details with the backend, bypassing backendCache, trying the credentials in turn while
+#the backend refuses them, up to SCHEDULE_SYNC_TRIES. Returns the data and the credentials that worked,
+#or (None, None) if the backend request failed
+def fetch_backend_data(endpoint, credentials):
+    for partCode, telegramid, token in credentials[:SCHEDULE_SYNC_TRIES]:
+        response = backend.get(endpoint, [partCode, telegramid, 1], headers={"token": token})
+        loaded = parse_backend_data(endpoint, response)
+        if loaded is not None:
+            return loaded[0], (partCode, telegramid, token)
+        if response is None or response.status_code >= 500:
+            #the backend is unavailable, other credentials would not help
+            break
+        logger.warning('Backend refused the credentials of %s for %s with %s', telegramid, endpoint, response.status_code,
+                       extra={'event': 'schedule_sync'})
+    return None, None
+
+#brings scheduleSnapshot up to date. Returns the differences between the old and new training list, or
+#None if the training list was not fetched
+def sync_schedule(dispatcher):
+    global scheduleSnapshot
+    credentials = service_credentials(dispatcher)
+    if not credentials:
+        SCHEDULE_SYNCS.inc('skipped')
+        return None
+    old = scheduleSnapshot
+    details, working = fetch_backend_data('details', credentials)
+    if details is None:
+        SCHEDULE_SYNCS.inc('failed')
+        logger.warning('Unable to sync the schedule, answering from the last snapshot', extra={'event': 'schedule_sync'})
+        return None
+    if old is not None and details["lastupdate"] == old.details["lastupdate"] and time.monotonic()-old.fetched < SCHEDULE_MAX_AGE:
+        if details != old.details:
+            scheduleSnapshot = old._replace(details=details)
+        SCHEDULE_SYNCS.inc('unchanged')
+        return None
+    training, _ = fetch_backend_data('training', [working]+[other for other in credentials if other != working])
+    if training is None:
+        SCHEDULE_SYNCS.inc('failed')
+        logger.warning('Unable to sync the schedule, answering from the last snapshot', extra={'event': 'schedule_sync'})
+        return None
+    scheduleSnapshot = ScheduleSnapshot(training, details, time.monotonic())
+    SCHEDULE_SYNCS.inc('updated')
+    if old is None:
+        logger.info('Loaded schedule of %d activities, last updated %s', len(training), details["lastupdate"], extra={'event': 'schedule_sync'})
+        return diff(ScheduleIndex([]), training)
+    changes = diff(old.training, training)
+    logger.info('Schedule last updated %s: %d added, %d changed, %d removed', details["lastupdate"],
+                len(changes.added), len(changes.changed), len(changes.removed), extra={'event': 'schedule_sync'})
+    return changes
+
+#one line per activity for the schedule change message
+def describe_activity(activity):
+    if activity.end is None:
+        return activity.title+": TBA"
+    return activity.title+":"+format_datetime(activity.start or activity.end, " %d %b %Y (%a), %I:%M%p")
+
+#message about the changes to activities that have not ended, None if there are none
+def format_changes(changes, now):
+    def upcoming(activity):
+        return activity.end is None or activity.end > now
+    lines = []
+    lines += ["\n🆕 "+describe_activity(activity) for activity in changes.added if upcoming(activity)]
+    lines += ["\n✏️ "+describe_activity(new) for old, new in changes.changed if upcoming(old) or upcoming(new)]
+    lines += ["\n❌ "+describe_activity(activity) for activity in changes.removed if upcoming(activity)]
+    if not lines:
+        return None
+    return "📢 *Schedule updated*"+"".join(lines)
+
+#job: syncs the schedule, reschedules the reminders when it has changed and optionally tells the users
+def sync_schedule_job(context):
+    old = scheduleSnapshot
+    changes = sync_schedule(context.dispatcher)
+    if not changes or old is None:
+        return
+    if REMINDER_OFFSETS:
+        context.job_queue.run_once(schedule_reminders, 0, name='schedule reminders')
+    if SCHEDULE_NOTIFY:
+        text = format_changes(changes, datetime.now(SGT))
+        if text is not None:
+            broadcast(context, text, 'Markdown')
+
+#job: (re)schedules a reminder job per upcoming activity and offset
+def schedule_reminders(context):
+    schedule = get_shared_data(context.dispatcher, 'training')
+    if schedule is None:
+        return
+    now = datetime.now(SGT)
+    for activity in schedule.remaining(now):
+        if activity.start is None:
+            continue
+        for offset in REMINDER_OFFSETS:
+            when = activity.start-timedelta(minutes=offset)
+            name = 'reminder '+activity.title+' '+activity.start.isoformat()+' '+str(offset)
+            if when > now and not context.job_queue.get_jobs_by_name(name):
+                #the job queue's scheduler only accepts pytz time zones
+                context.job_queue.run_once(send_reminder, when.astimezone(pytz.utc), context=(activity, offset), name=name)
+
+#job: sends the details of the job's activity, rendered once, to every logged in user
+def send_reminder(context):
+    activity, offset = context.job.context
+    data = {endpoint: get_shared_data(context.dispatcher, endpoint) for endpoint in ('training', 'details')}
+    if None in data.values():
+        logger.error('Failed to get DB data for %s', context.job.name, extra={'event': 'backend_error', 'handler': context.job.name})
+        return
+    now = datetime.now(SGT)
+    #the activity as it is in the schedule now, another one may still be running before it
+    current = next((remaining for remaining in data['training'].remaining(now)
+                    if (remaining.title, remaining.start) == (activity.title, activity.start)), None)
+    if current is None:
+        #moved or removed since the job was scheduled
+        logger.info('Skipping %s, no longer in the schedule', context.job.name, extra={'event': 'reminder_skipped', 'handler': context.job.name})
+        return
+    text = render_activity(current, data['details'])
+    broadcast(context, '⏰ *Reminder*: starting in '+format_offset(offset)+'\n\n'+text, 'Markdown')
+
+#job: sends the daily encouragement link to every logged in user
+def send_daily_encouragement(context):
+    text, parse_mode = answer_daily_encouragement({}, datetime.now(SGT))
+    broadcast(context, "Today's daily encouragement: "+text, parse_mode)
+
+def schedule_reminder_jobs(job_queue):
+    if REMINDER_OFFSETS:
+        job_queue.run_repeating(schedule_reminders, REMINDER_REFRESH, first=10, name='schedule reminders')
+    if DAILY_ENCOURAGEMENT_TIME:
+        at = datetime.strptime(DAILY_ENCOURAGEMENT_TIME, '%H:%M').time().replace(tzinfo=pytz.timezone('Asia/Singapore'))
+        job_queue.run_daily(send_daily_encouragement, at, name='daily encouragement')
+
+#/profile handler, only registered for ADMIN_IDS
+@metrics.instrument('profile')
+def profile(update, context):
+    chat_id = update.effective_chat.id
+    args = context.args
+    if args and args[0] == "stop":
+        for job in context.job_queue.get_jobs_by_name('profile report'):
+            job.schedule_removal()
+        finish_profile(context.bot, chat_id)
+        return
+    try:
+        seconds = int(args[0]) if args else PROFILE_SECONDS
+        rate = float(args[1]) if len(args) > 1 else PROFILE_RATE
+    except ValueError:
+        seconds = rate = 0
+    if seconds <= 0 or not 0 < rate <= 1:
+        update.message.reply_text('Usage: /profile [seconds] [fraction of updates, up to 1] or /profile stop')
+        return
+    for job in context.job_queue.get_jobs_by_name('profile report'):
+        job.schedule_removal()
+    PROFILER.start(seconds, rate)
+    context.job_queue.run_once(send_profile_report, seconds, context=chat_id, name='profile report')
+    update.message.reply_text('Profiling '+format(rate, '.0%')+' of updates for '+str(seconds)+' seconds, the report will be sent here')
+
+#stops profiling and sends the report to chat_id, or writes it to PROFILE_REPORT when chat_id is None
+def finish_profile(bot, chat_id):
+    PROFILER.stop()
+    report = PROFILER.report()
+    if chat_id is None:
+        with open(PROFILE_REPORT, 'w', encoding='utf-8') as f:
+            f.write(report)
+        logger.info('Profile report written to %s', PROFILE_REPORT, extra={'event': 'profile_report'})
+    else:
+        filename = 'profile-'+datetime.now(SGT).strftime('%Y%m%d-%H%M%S')+'.txt'
+        bot.send_document(chat_id, document=io.BytesIO(report.encode('utf-8')), filename=filename)
+        logger.info('Profile report sent to %s', chat_id, extra={'event': 'profile_report'})
+
+#job: ends the profiling window started by /profile or PROFILE_ON_START
+def send_profile_report(context):
+    finish_profile(context.bot, context.job.context)
+
+#marks the user's session as seen, runs before the other handlers
+def touch_session(update, context):
+    if context.user_data is not None:
+        context.user_data.lastSeen = time.time()
+
+#job: evicts idle sessions together with their conversation states and saved copies
+def evict_idle_sessions(context):
+    dispatcher = context.dispatcher
+    evicted = set(evict_sessions(dispatcher.user_data, SESSION_IDLE_TTL, SESSION_ANONYMOUS_TTL, SESSION_MAX))
+    if sessionStore is not None:
+        #the store drops the conversation states of the sessions it evicts
+        sessionStore.evict(SESSION_IDLE_TTL, SESSION_ANONYMOUS_TTL, SESSION_MAX)
+    if not evicted:
+        return
+    persistence = dispatcher.persistence
+    if sessionStore is None:
+        for handler in dispatcher.handlers[0]:
+            if not isinstance(handler, ConversationHandler):
+                continue
+            with handler._conversations_lock:
+                #states of async handlers still running are left alone
+                keys = [key for key, state in list(handler.conversations.items()) if key[-1] in evicted and not isinstance(state, tuple)]
+                for key in keys:
+                    del handler.conversations[key]
+            if persistence is not None and handler.persistent:
+                for key in keys:
+                    persistence.update_conversation(handler.name, key, None)
+    if persistence is not None:
+        for user_id in evicted:
+            persistence.drop_user_data(user_id)
+    logger.info('Evicted %d idle sessions', len(evicted), extra={'event': 'sessions_evicted'})
+
 #/error handler
 def error(update, context):
     """Log Errors caused by Updates."""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
 
-def main():
-    """Start the bot."""
-    # Create the Updater and pass it your bot's token.
+#gauges read from the caches, login guard and circuit breaker when metrics are scraped
+def register_metrics(dispatcher):
+    def cache_stats():
+        values = {}
+        for name, cache in (('backend', backendCache), ('reply', replyCache), ('blocked', blockedAccounts)):
+            for stat, value in cache.stats().items():
+                values[(name, stat)] = value
+        return values
+    metrics.REGISTRY.gauge('namjaninjabot_cache', 'Cache entries, bytes and hit/miss counts', cache_stats, ('cache', 'stat'))
+    metrics.REGISTRY.gauge('namjaninjabot_login_guard', 'Login requests answered without the backend',
+                           lambda: {(stat,): value for stat, value in login_guard_stats().items()}, ('stat',))
+    metrics.REGISTRY.gauge('namjaninjabot_backend_breaker_open', '1 while the backend circuit breaker is open',
+                           lambda: int(backend.breaker.state == 'open'))
+    if feedbackSpool is not None:
+        metrics.REGISTRY.gauge('namjaninjabot_feedback_spool_depth', 'Feedback submissions waiting in the spool', lambda: len(feedbackSpool))
+    metrics.REGISTRY.gauge('namjaninjabot_sessions', 'Live and logged in sessions held by this process and the bytes they use',
+                           lambda: {(stat,): value for stat, value in session_stats(dispatcher.user_data).items()}, ('stat',))
+    if sessionStore is not None:
+        metrics.REGISTRY.gauge('namjaninjabot_session_store', 'Sessions, bytes, conversations and locked sessions in the session store',
+                               lambda: {(stat,): value for stat, value in sessionStore.stats().items()}, ('stat',))
+    metrics.REGISTRY.gauge('namjaninjabot_schedule_age_seconds', 'Seconds since the training list of the schedule snapshot was fetched',
+                           lambda: {} if scheduleSnapshot is None else round(time.monotonic()-scheduleSnapshot.fetched, 1))
+    metrics.REGISTRY.gauge('namjaninjabot_ready', '1 once the bot has warmed up and serves updates', lambda: int(ready.is_set()))
+    metrics.REGISTRY.gauge('namjaninjabot_startup_seconds', 'Seconds spent in each warm up step, and from start to ready in total',
+                           lambda: {(name,): round(seconds, 3) for name, seconds in startupTimings.items()}, ('step',))
+    if delivery is not None:
+        metrics.REGISTRY.gauge('namjaninjabot_delivery_queue_depth', 'Messages waiting in the delivery queue, by priority',
+                               lambda: {(priority,): depth for priority, depth in delivery.depth().items()}, ('priority',))
+
+#fetches training and details with the credentials of a logged in user, and renders the answer to every
+#query so that the parsed schedule and the replies are cached. Returns False if there was nothing to fetch
+def prefetch_schedule(dispatcher):
+    if not service_credentials(dispatcher):
+        logger.info('Nobody is logged in, not prefetching the schedule', extra={'event': 'warm_up'})
+        return False
+    if SCHEDULE_SYNC_INTERVAL:
+        sync_schedule(dispatcher)
+    data = {endpoint: get_shared_data(dispatcher, endpoint) for endpoint in ('training', 'details')}
+    if None in data.values():
+        logger.warning('Unable to prefetch the schedule', extra={'event': 'warm_up'})
+        return False
+    today = datetime.now(SGT)
+    for needs, answer, failure in QUERIES.values():
+        answer({endpoint: data[endpoint] for endpoint in needs}, today)
+    return True
+
+#warms up the connections and caches the first updates would otherwise wait on, records how long each
+#step took in startupTimings and sets ready
+def warm_up(updater):
+    def step(name, func, *args):
+        started = time.monotonic()
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Warm up step %s failed', name, extra={'event': 'warm_up'})
+        startupTimings[name] = time.monotonic()-started
+    if WARMUP:
+        step('telegram', updater.bot.get_me)
+        step('backend', backend.warm_up)
+        step('schedule', prefetch_schedule, updater.dispatcher)
+    startupTimings['total'] = time.monotonic()-startedAt
+    ready.set()
+    logger.info('Ready in %.2fs (%s)', startupTimings['total'],
+                ', '.join('%s %.2fs' % (name, seconds) for name, seconds in startupTimings.items() if name != 'total'),
+                extra={'event': 'ready', 'latency': elapsed_ms(startedAt)})
+
+#starts the event loop and aiohttp backend client used in ASYNC_MODE
+def start_engine(dispatcher):
+    global engine, asyncBackend
+    engine = AsyncEngine(workers=WORKERS)
+    asyncBackend = AsyncBackendClient(baseurl, limit=int(os.environ.get("ASYNC_CONNECTIONS", "100")), breaker=backend.breaker)
+    engine.on_stop(asyncBackend.close)
+    engine.start(dispatcher)
+
+def build_updater(request=None):
+    """Create the Updater and register the handlers, without starting it.
+
+    request replaces the telegram Request the bot sends API calls with, the benchmarks pass one that
+    does not talk to Telegram.
+    """
+    global delivery, feedbackSpool, sessionStore, typingTimer
+    persistence = None
+    if SESSION_STORE:
+        sessionStore = open_store(SESSION_STORE, SESSION_AUTHKEY)
+        if SESSION_DB:
+            logger.warning('SESSION_STORE is set, not saving sessions to %s', SESSION_DB)
+    elif SESSION_DB:
+        persistence = SQLitePersistence(SESSION_DB, flush_interval=int(os.environ.get("SESSION_FLUSH_INTERVAL", "5")), user_data_type=Session,
+                                        shard=None if SHARD_INDEX is None else (SHARD_INDEX, SHARDS))
+    #handlers that use user_data load it from the session store and save it back
+    def session(handler):
+        return handler if sessionStore is None else bind_user_data(handler, sessionStore)
+    if FEEDBACK_SPOOL:
+        feedbackSpool = FeedbackSpool(FEEDBACK_SPOOL, submit_feedback, batch_size=FEEDBACK_BATCH, interval=FEEDBACK_RETRY).start()
+    #the global flood limit is shared by all shard workers
+    delivery = DeliveryQueue(rate=DELIVERY_RATE/SHARDS, chat_rate=DELIVERY_CHAT_RATE, chat_burst=DELIVERY_CHAT_BURST, senders=DELIVERY_SENDERS)
+    typingTimer = DelayedCalls()
+    if request is None:
+        request = Request(con_pool_size=WORKERS+DELIVERY_SENDERS+4)
+    # Create the Updater and pass it your bot.
     # Make sure to set use_context=True to use the new context based callbacks
     # Post version 12 this will no longer be necessary
-    updater = Updater(TOKEN, use_context=True)
+    updater = Updater(bot=QueuedBot(TOKEN, delivery, request=request), use_context=True, workers=WORKERS, persistence=persistence,
+                      context_types=ContextTypes(user_data=Session))
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
 
+    # keep track of when each user was last seen, for evicting idle sessions
+    dp.add_handler(TypeHandler(Update, touch_session), group=-1)
+
+    if ASYNC_MODE:
+        start_engine(dp)
+        loginStepHandler = engine.handler(session(login_step_async))
+        firstStepHandler = engine.handler(session(first_step_async))
+        replyHandler = engine.handler(session(reply_async))
+    else:
+        loginStepHandler = session(login_step)
+        firstStepHandler = session(first_step)
+        replyHandler = session(reply)
+
     # handle login conversation
     conversation_handlerLogin = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[CommandHandler('start', session(start)), CommandHandler('login', session(login))],
         states={
-            LOGIN_STEP: [MessageHandler(~Filters.command, login_step)],
+            LOGIN_STEP: [MessageHandler(~Filters.command, loginStepHandler)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', session(cancel))],
+        name='login',
+        persistent=persistence is not None
     )
+    if sessionStore is not None:
+        conversation_handlerLogin.conversations = ConversationStates(sessionStore, 'login')
+    if ASYNC_MODE:
+        engine.resume_after_pending(conversation_handlerLogin)
     dp.add_handler(conversation_handlerLogin)
 
     # on different commands - answer in Telegram
     dp.add_handler(CommandHandler("help", help))
     dp.add_handler(CommandHandler("about", about))
     dp.add_handler(CommandHandler("share", share))
+    if ADMIN_IDS:
+        dp.add_handler(CommandHandler("profile", profile, filters=Filters.user(user_id=ADMIN_IDS)))
 
     # handle feedback conversation
     conversation_handler = ConversationHandler(
-        entry_points=[CommandHandler('feedback', feedback)],
+        entry_points=[CommandHandler('feedback', session(feedback))],
         states={
-            FIRST_STEP: [MessageHandler(~Filters.command, first_step)],
+            FIRST_STEP: [MessageHandler(~Filters.command, firstStepHandler)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', session(cancel))],
+        name='feedback',
+        persistent=persistence is not None
     )
+    if sessionStore is not None:
+        conversation_handler.conversations = ConversationStates(sessionStore, 'feedback')
+    if ASYNC_MODE:
+        engine.resume_after_pending(conversation_handler)
     dp.add_handler(conversation_handler)
 
     # on noncommand i.e message - reply the message on Telegram
-    dp.add_handler(MessageHandler(~Filters.command, reply))
+    dp.add_handler(MessageHandler(~Filters.command, replyHandler))
+    dp.add_handler(CallbackQueryHandler(session(show_all_page), pattern=r'^all \d+ \d+$'))
 
     # log all errors
     dp.add_error_handler(error)
 
+    # reminders pushed to logged in users
+    schedule_reminder_jobs(updater.job_queue)
+    if SCHEDULE_SYNC_INTERVAL:
+        updater.job_queue.run_repeating(sync_schedule_job, SCHEDULE_SYNC_INTERVAL, first=SCHEDULE_SYNC_INTERVAL, name='schedule sync')
+    if SESSION_EVICT_INTERVAL:
+        updater.job_queue.run_repeating(evict_idle_sessions, SESSION_EVICT_INTERVAL, first=SESSION_EVICT_INTERVAL, name='evict sessions')
+    if PROFILE_ON_START:
+        PROFILER.start(PROFILE_SECONDS, PROFILE_RATE)
+        updater.job_queue.run_once(send_profile_report, PROFILE_SECONDS, context=None, name='profile report')
+
+    register_metrics(dp)
+    return updater
+
+#stops the background threads started by build_updater(), once the updater has stopped
+def shutdown():
+    if engine is not None:
+        engine.stop()
+    typingTimer.stop()
+    delivery.stop()
+    if feedbackSpool is not None:
+        feedbackSpool.stop()
+
+def main():
+    """Start the bot."""
+    if SHARDS > 1:
+        # route updates to the shard worker processes instead of handling them here
+        router = ShardRouter(SHARDS).start()
+        updater = Updater(TOKEN, use_context=True)
+        updater.dispatcher.add_handler(TypeHandler(Update, router.route))
+        metrics.REGISTRY.gauge('namjaninjabot_shard_queue_depth', 'Updates waiting for each worker process', router.depth, ('shard',))
+    else:
+        router = None
+        updater = build_updater()
+    if METRICS_PORT:
+        try:
+            metrics.serve(METRICS_PORT, METRICS_HOST, ready=ready.is_set)
+        except OSError as e:
+            logger.error('Unable to serve metrics on port %d: %s', METRICS_PORT, e)
+    # the shard workers warm up on their own, updates wait in their queues until then
+    if router is None:
+        warm_up(updater)
+    else:
+        ready.set()
+
     # Start the Bot
     # updater.start_polling()
     PORT = int(os.environ.get("PORT", "8443"))
@@ -578,6 +1372,10 @@ def main():
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
+    if router is not None:
+        router.stop()
+    else:
+        shutdown()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""
+Small in-process cache used in front of the NamjaNinjaBot backend API.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Flight:
+    """A load that is currently in progress for one key"""
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """TTL + LRU cache bounded by entry count and approximate bytes.
+
+    Concurrent misses on the same key are coalesced through get_or_load so that
+    only one caller runs the loader while the others wait for its result.
+    """
+
+    def __init__(self, maxsize=128, ttl=60, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self._data = OrderedDict()  # key -> (expires, value, size)
+        self._inflight = {}
+        self._ainflight = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _lookup(self, key, now):
+        #must be called with the lock held
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        if entry[0] <= now:
+            self._remove(key)
+            return False, None
+        self._data.move_to_end(key)
+        return True, entry[1]
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key, time.monotonic())
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None, size=None):
+        if ttl is None:
+            ttl = self.ttl
+        if size is None:
+            size = sys.getsizeof(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            #would evict everything else and still not fit
+            return
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (time.monotonic() + ttl, value, size)
+            self.bytes += size
+            while len(self._data) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            self._remove(key)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def get_or_load(self, key, loader, ttl=None, size=None):
+        """Return the cached value for key, calling loader() once on a miss.
+
+        A loader result of None is handed to any waiting callers but is not cached.
+        size may be a callable that is given the loaded value.
+        """
+        with self._lock:
+            found, value = self._lookup(key, time.monotonic())
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = loader()
+            if flight.value is not None:
+                self.set(key, flight.value, ttl, size(flight.value) if callable(size) else size)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    async def get_or_load_async(self, key, loader, ttl=None, size=None):
+        """Coroutine version of get_or_load for callers running on one event loop.
+
+        loader is a coroutine function. Concurrent misses on the loop await the same load.
+        """
+        with self._lock:
+            found, value = self._lookup(key, time.monotonic())
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            future = self._ainflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self._ainflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await loader()
+            if value is not None:
+                self.set(key, value, ttl, size(value) if callable(size) else size)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            #mark as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self._ainflight[key]
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+        }
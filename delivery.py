@@ -0,0 +1,278 @@
+"""
+Outbound message queue for NamjaNinjaBot that keeps the bot within Telegram's flood limits.
+"""
+
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+import metrics
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Message priorities, interactive replies are always sent before bulk ones
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = ('interactive', 'bulk')
+
+DELIVERY_WAIT = metrics.REGISTRY.histogram('namjaninjabot_delivery_wait_seconds',
+                                           'Time messages spent in the delivery queue, by priority', ('priority',))
+DELIVERY_SENT = metrics.REGISTRY.counter('namjaninjabot_delivery_sent_total',
+                                         'Messages sent by the delivery queue, by priority and outcome', ('priority', 'outcome'))
+DELIVERY_RETRY_AFTER = metrics.REGISTRY.counter('namjaninjabot_delivery_retry_after_total',
+                                                'Flood control errors (429) returned by Telegram')
+
+
+class _Message:
+    __slots__ = ('chat_id', 'func', 'priority', 'future', 'queued', 'attempts')
+
+    def __init__(self, chat_id, func, priority):
+        self.chat_id = chat_id
+        self.func = func
+        self.priority = priority
+        self.future = Future()
+        self.queued = time.monotonic()
+        self.attempts = 0
+
+
+class DeliveryQueue:
+    """Sends Bot API calls within a global and a per-chat rate limit.
+
+    Calls are queued per priority and handed to `senders` threads once a token is available in the
+    global bucket (`rate` per second). Bulk calls also wait for a token in the bucket of their chat
+    (`chat_rate` per second, up to `chat_burst` at once). Interactive calls take a token from it
+    when there is one but never wait for it, the handler waiting for them would hold up the
+    updates of every other chat. Calls to the same chat are sent one at a time and in order. A 429
+    from Telegram pauses all sending for its retry_after and the call is queued again, up to
+    `max_retries` times.
+    """
+
+    def __init__(self, rate=30, chat_rate=1, chat_burst=3, senders=4, max_retries=3, max_chats=10000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._global = TokenBucket(rate, rate)
+        self._chats = OrderedDict()  # chat id -> TokenBucket
+        self._queues = tuple(deque() for _ in PRIORITY_NAMES)
+        self._busy = set()  # chats with a call being sent
+        self._pausedUntil = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=senders, thread_name_prefix='Delivery')
+        self._thread = threading.Thread(target=self._run, name='DeliveryQueue', daemon=True)
+        self._thread.start()
+
+    def submit(self, chat_id, func, /, *args, priority=INTERACTIVE, **kwargs):
+        """Queue func(*args, **kwargs), returns a concurrent.futures.Future of its result"""
+        message = _Message(chat_id, functools.partial(func, *args, **kwargs), priority)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('Delivery queue is stopped')
+            self._queues[priority].append(message)
+            self._cond.notify()
+        return message.future
+
+    def send(self, chat_id, func, /, *args, **kwargs):
+        """Queue an interactive call and wait for its result"""
+        return self.submit(chat_id, func, *args, **kwargs).result()
+
+    def depth(self):
+        return {name: len(queue) for name, queue in zip(PRIORITY_NAMES, self._queues)}
+
+    def stop(self, timeout=10):
+        """Send what is queued and stop"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _next(self, now):
+        #must be called with the condition held. Returns (message, None), or (None, seconds to wait) where
+        #None means until notified
+        if now < self._pausedUntil:
+            return None, self._pausedUntil-now
+        wait = self._global.wait_time(1, now)
+        if wait > 0:
+            return None, wait
+        wait = None
+        #a chat that is skipped once is skipped for the rest of the scan so that its calls stay in order
+        skipped = set()
+        for queue in self._queues:
+            for i, message in enumerate(queue):
+                chat_id = message.chat_id
+                if chat_id in skipped or chat_id in self._busy:
+                    skipped.add(chat_id)
+                    continue
+                if chat_id is not None:
+                    bucket = self._chat_bucket(chat_id)
+                    if message.priority == INTERACTIVE:
+                        bucket.consume(1, now)
+                    else:
+                        chatWait = bucket.wait_time(1, now)
+                        if chatWait > 0:
+                            skipped.add(chat_id)
+                            wait = chatWait if wait is None else min(wait, chatWait)
+                            continue
+                        bucket.consume(1, now)
+                    self._busy.add(chat_id)
+                self._global.consume(1, now)
+                del queue[i]
+                return message, None
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped and not any(self._queues) and not self._busy:
+                        return
+                    message, wait = self._next(time.monotonic())
+                    if message is not None:
+                        break
+                    self._cond.wait(wait)
+            if message.attempts == 0:
+                DELIVERY_WAIT.observe(time.monotonic()-message.queued, PRIORITY_NAMES[message.priority])
+            self._executor.submit(self._send, message)
+
+    def _send(self, message):
+        priority = PRIORITY_NAMES[message.priority]
+        try:
+            result = message.func()
+        except RetryAfter as e:
+            DELIVERY_RETRY_AFTER.inc()
+            with self._cond:
+                self._pausedUntil = max(self._pausedUntil, time.monotonic()+e.retry_after)
+                self._busy.discard(message.chat_id)
+                if message.attempts < self.max_retries:
+                    logger.warning('Flood control exceeded, pausing delivery for %ss', e.retry_after)
+                    message.attempts += 1
+                    self._queues[message.priority].appendleft(message)
+                    self._cond.notify()
+                    return
+                self._cond.notify()
+            DELIVERY_SENT.inc(priority, 'retry_after')
+            message.future.set_exception(e)
+        except Exception as e:
+            self._done(message)
+            DELIVERY_SENT.inc(priority, 'error')
+            message.future.set_exception(e)
+        else:
+            self._done(message)
+            DELIVERY_SENT.inc(priority, 'ok')
+            message.future.set_result(result)
+
+    def _done(self, message):
+        with self._cond:
+            self._busy.discard(message.chat_id)
+            self._cond.notify()
+
+
+class _DelayedCall:
+    __slots__ = ('func', 'args', 'cancelled')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class DelayedCalls:
+    """Runs calls after a delay on one shared thread, unless they are cancelled first.
+
+    Scheduling and cancelling only take a lock. Meant for short calls such as queueing a message, a
+    call that blocks holds up the ones due after it.
+    """
+
+    def __init__(self):
+        self._heap = []  # (due, sequence, _DelayedCall)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='DelayedCalls', daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay, func, *args):
+        """Call func(*args) in delay seconds. Returns a handle whose cancel() drops the call if it has not run"""
+        call = _DelayedCall(func, args)
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic()+delay, next(self._sequence), call))
+            #the thread only needs waking when this call is due before the one it waits for
+            if self._heap[0][2] is call:
+                self._cond.notify()
+        return call
+
+    def stop(self, timeout=10):
+        """Stop without running the calls that are not due yet"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    wait = None
+                    if self._heap:
+                        wait = self._heap[0][0]-time.monotonic()
+                        if wait <= 0:
+                            _, _, call = heapq.heappop(self._heap)
+                            break
+                    self._cond.wait(wait)
+            if call.cancelled:
+                continue
+            try:
+                call.func(*call.args)
+            except Exception:
+                logger.exception('Delayed call failed')
+
+
+class QueuedBot(Bot):
+    """Bot whose messages go through a DeliveryQueue.
+
+    send_message, edit_message_text and send_document wait for their turn in the queue as
+    interactive calls. queue_message sends a bulk message without waiting for it.
+    """
+
+    def __init__(self, token, delivery, request=None):
+        super().__init__(token, request=request)
+        self.delivery = delivery
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self.delivery.send(chat_id, super().send_message, chat_id, *args, **kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self.delivery.send(kwargs.get('chat_id'), super().edit_message_text, *args, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self.delivery.send(chat_id, super().send_document, chat_id, *args, **kwargs)
+
+    def queue_message(self, chat_id, text, **kwargs):
+        """Queue a bulk message, returns a Future of the sent Message"""
+        return self.delivery.submit(chat_id, super().send_message, chat_id, text, priority=BULK, **kwargs)
@@ -0,0 +1,154 @@
+"""
+Asyncio execution mode for NamjaNinjaBot handlers.
+
+python-telegram-bot 13 runs handlers on a small pool of dispatcher threads. With the async engine,
+handlers that wait on the backend are coroutines on one event loop instead, so a dispatcher thread
+is only held for as long as it takes to schedule the coroutine.
+"""
+
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+from telegram.ext import ConversationHandler, TypeHandler
+from telegram.ext.utils.promise import Promise
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncEngine:
+    """Event loop on a background thread that runs coroutine handlers.
+
+    Calls into the (blocking) Telegram Bot API are made with to_thread, on a pool of `workers`
+    threads, so they never stall the loop.
+    """
+
+    def __init__(self, workers=4):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='AsyncEngine')
+        self.loop.set_default_executor(self.executor)
+        self.dispatcher = None
+        self._on_stop = []
+        self._waiting = {}  # Promise of a running handler -> updates to dispatch again once it is done
+        self._waitingLock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='AsyncEngine', daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self, dispatcher=None):
+        self.dispatcher = dispatcher
+        self._thread.start()
+
+    def on_stop(self, coroutine_function):
+        """Register a coroutine function to be awaited when the engine stops"""
+        self._on_stop.append(coroutine_function)
+
+    def stop(self, timeout=10):
+        async def shutdown():
+            for callback in self._on_stop:
+                await callback()
+        if self._thread.is_alive():
+            try:
+                self.submit(shutdown()).result(timeout)
+            except Exception:
+                logger.exception('Error while stopping async engine')
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout)
+        self.executor.shutdown(wait=False)
+
+    def submit(self, coro):
+        """Schedule a coroutine from any thread, returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def to_thread(self, func, *args, **kwargs):
+        """Run a blocking call on the engine's thread pool, returns an awaitable"""
+        return self.loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    def fire(self, func, *args, **kwargs):
+        """Run a blocking call on the thread pool without waiting for it"""
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def handler(self, coroutine_function):
+        """Wrap a coroutine handler into a dispatcher callback.
+
+        The callback returns a Promise that is resolved with the coroutine's return value, which
+        ConversationHandler understands, so conversation states keep working as with sync handlers.
+        """
+        @functools.wraps(coroutine_function)
+        def callback(update, context):
+            future = self.submit(coroutine_function(update, context))
+            promise = Promise(future.result, (), {}, update=update)
+            with self._waitingLock:
+                self._waiting[promise] = []
+            future.add_done_callback(lambda _: self.fire(self._resolve, promise, update))
+            return promise
+        return callback
+
+    def _resolve(self, promise, update):
+        #runs on the thread pool once the coroutine is done, error handlers and persistence may block
+        promise.run()
+        if promise.exception is not None:
+            if self.dispatcher is not None:
+                self.dispatcher.dispatch_error(update, promise.exception, promise)
+            else:
+                logger.error('Async handler raised', exc_info=promise.exception)
+        elif self.dispatcher is not None and self.dispatcher.persistence is not None:
+            #the dispatcher saved user_data when the handler returned its Promise, before the coroutine ran
+            self._settle_conversations(promise, update)
+            self.dispatcher.update_persistence(update=update)
+        with self._waitingLock:
+            waiting = self._waiting.pop(promise, ())
+        if self.dispatcher is not None:
+            for pending in waiting:
+                self.dispatcher.update_queue.put(pending)
+
+    def resume_after_pending(self, conversation):
+        """Dispatch updates that arrive while an async handler of `conversation` is still running again once it is done.
+
+        Without this ConversationHandler drops them to later handlers, which is not what the same user
+        would see with sync handlers since the dispatcher handles their updates one at a time. The
+        dispatcher thread does not wait for the handler, the updates are put back on its queue.
+        """
+        def dispatch_when_done(update, context):
+            key = conversation._get_key(update)
+            with conversation._conversations_lock:
+                state = conversation.conversations.get(key)
+            promise = state[1] if isinstance(state, tuple) and len(state) == 2 else None
+            with self._waitingLock:
+                waiting = self._waiting.get(promise)
+                if waiting is not None:
+                    waiting.append(update)
+                    return
+            #the handler finished in the meantime
+            context.dispatcher.update_queue.put(update)
+
+        conversation.states[ConversationHandler.WAITING] = [TypeHandler(Update, dispatch_when_done)]
+
+    def _settle_conversations(self, promise, update):
+        #ConversationHandler only swaps (old state, promise) for the new state on the user's next update,
+        #until then persistence would keep the old state
+        for handlers in self.dispatcher.handlers.values():
+            for handler in handlers:
+                if not isinstance(handler, ConversationHandler) or not handler.persistent:
+                    continue
+                try:
+                    key = handler._get_key(update)
+                except AttributeError:
+                    continue
+                with handler._conversations_lock:
+                    state = handler.conversations.get(key)
+                if isinstance(state, tuple) and len(state) == 2 and state[1] is promise:
+                    handler._update_state(handler._resolve_promise(state), key)
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error('Background call failed', exc_info=future.exception())
+
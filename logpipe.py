@@ -0,0 +1,133 @@
+"""
+Logging setup for NamjaNinjaBot: structured records written by a background thread.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+
+# Structured fields handlers pass to log calls through `extra`
+FIELDS = ('event', 'handler', 'participantCode', 'latency')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class StructuredFormatter(logging.Formatter):
+    """Appends the structured fields of a record to the text line, or formats it as one JSON object"""
+
+    def __init__(self, fmt=TEXT_FORMAT, json_output=False):
+        super().__init__(fmt)
+        self.json_output = json_output
+
+    def format(self, record):
+        fields = {name: getattr(record, name) for name in FIELDS if getattr(record, name, None) is not None}
+        if self.json_output:
+            entry = {
+                'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+            }
+            entry.update(fields)
+            if record.exc_info:
+                entry['exc_info'] = self.formatException(record.exc_info)
+            return json.dumps(entry)
+        line = super().format(record)
+        if fields:
+            line += ' [' + ' '.join(name+'='+str(value) for name, value in fields.items()) + ']'
+        return line
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    The stdlib QueueHandler formats the message in the logging thread before queueing it. Log call
+    arguments in this bot are strings, numbers and LazyUser wrappers that do not change after the
+    call, so that can safely be deferred.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of INFO and lower records, per structured event type.
+
+    rates maps event -> fraction of records to keep. Events that are not listed are always kept.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rates.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+
+def parse_sample_rates(value):
+    """Parses "question=0.1,answered=0.5" into {'question': 0.1, 'answered': 0.5}"""
+    rates = {}
+    for item in value.split(','):
+        if '=' in item:
+            event, rate = item.split('=', 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+_configured = False
+_listener = None
+
+
+def setup_logging(level=logging.INFO, json_output=False, sample_rates=None, use_queue=True):
+    """Configures the root logger. Returns the QueueListener writing the records, or None.
+
+    Only the first call has an effect. Shard worker processes import the bot module twice, as the
+    __main__ module of the webhook process and as itself.
+    """
+    global _configured, _listener
+    if _configured:
+        return _listener
+    _configured = True
+    formatter = StructuredFormatter(json_output=json_output)
+    stream = logging.StreamHandler()
+    stream.setFormatter(formatter)
+    root = logging.getLogger()
+    root.setLevel(level)
+    listener = None
+    if use_queue:
+        handler = LazyQueueHandler(queue.SimpleQueue())
+        listener = logging.handlers.QueueListener(handler.queue, stream, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        _listener = listener
+    else:
+        handler = stream
+    if sample_rates:
+        handler.addFilter(SamplingFilter(sample_rates))
+    root.addHandler(handler)
+    return listener
+
+
+class LazyUser:
+    """Log argument for a Telegram user, formatted as "First (username, id)" only when written"""
+    __slots__ = ('user',)
+
+    def __init__(self, user):
+        self.user = user
+
+    def __str__(self):
+        if self.user.username is None:
+            return '%s (%s)' % (self.user.first_name, self.user.id)
+        return '%s (%s, %s)' % (self.user.first_name, self.user.username, self.user.id)
+
+
+def elapsed_ms(started):
+    """Milliseconds since a time.monotonic() timestamp, for the latency field"""
+    return round((time.monotonic()-started)*1000, 1)
@@ -0,0 +1,256 @@
+"""
+Counters and latency histograms for NamjaNinjaBot, served in the Prometheus text format.
+"""
+
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from profiler import PROFILER
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{'+','.join(pairs)+'}' if pairs else ''
+
+
+class Counter:
+    """Monotonic count per combination of label values"""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0)+amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append('%s%s %s' % (self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Histogram:
+    """Distribution of observed values per combination of label values"""
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [per bucket counts (last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0]*(len(self.buckets)+1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, *labels):
+        entry = self._values.get(labels)
+        return 0 if entry is None else sum(entry[0])
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets+('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labelnames, labels, 'le="%s"' % bound), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labelnames, labels), total))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+class GaugeCallback:
+    """Gauges read from a function at scrape time.
+
+    The function returns a number, or a dict of label value tuple -> number.
+    """
+
+    def __init__(self, name, help, func, labelnames=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s gauge' % self.name]
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append('%s%s %s' % (self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            #registering a name twice returns the existing metric
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, func, labelnames=()):
+        with self._lock:
+            metric = self._metrics[name] = GaugeCallback(name, help, func, labelnames)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logger.exception('Failed to collect metric %s', metric.name)
+        return '\n'.join(lines)+'\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_REQUESTS = REGISTRY.counter('namjaninjabot_handler_requests_total',
+                                    'Updates handled, by handler, query and outcome', ('handler', 'query', 'outcome'))
+HANDLER_LATENCY = REGISTRY.histogram('namjaninjabot_handler_latency_seconds',
+                                     'Time spent in a handler, by handler and query', ('handler', 'query'))
+BACKEND_REQUESTS = REGISTRY.counter('namjaninjabot_backend_requests_total',
+                                    'Backend HTTP requests, by endpoint, method and status', ('endpoint', 'method', 'status'))
+BACKEND_LATENCY = REGISTRY.histogram('namjaninjabot_backend_latency_seconds',
+                                     'Backend HTTP request time, by endpoint and method', ('endpoint', 'method'))
+
+
+def observe_backend(endpoint, method, status, started):
+    """Record one backend HTTP attempt. status is the HTTP status code or a failure reason"""
+    BACKEND_REQUESTS.inc(endpoint, method, str(status))
+    if started is not None:
+        BACKEND_LATENCY.observe(time.monotonic()-started, endpoint, method)
+
+
+def instrument(name, query=None):
+    """Count and time a handler, sync or coroutine.
+
+    query is an optional function of the update that returns the query label, e.g. the question
+    asked. Exceptions are counted with outcome "error" and re-raised. Sync handlers are also handed
+    to the profiler while it is enabled.
+    """
+    def decorator(handler):
+        def record(update, started, outcome):
+            label = query(update) if query is not None else ''
+            HANDLER_REQUESTS.inc(name, label, outcome)
+            HANDLER_LATENCY.observe(time.monotonic()-started, name, label)
+
+        def profile_label(update):
+            return name+': '+query(update) if query is not None else name
+
+        if asyncio.iscoroutinefunction(handler):
+            @functools.wraps(handler)
+            async def wrapper(update, context):
+                started = time.monotonic()
+                try:
+                    result = await handler(update, context)
+                except Exception:
+                    record(update, started, 'error')
+                    raise
+                record(update, started, 'ok')
+                return result
+        else:
+            @functools.wraps(handler)
+            def wrapper(update, context):
+                started = time.monotonic()
+                try:
+                    if PROFILER.enabled:
+                        result = PROFILER.call(profile_label(update), handler, update, context)
+                    else:
+                        result = handler(update, context)
+                except Exception:
+                    record(update, started, 'error')
+                    raise
+                record(update, started, 'ok')
+                return result
+        return wrapper
+    return decorator
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+    ready = None
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/ready' and self.ready is not None:
+            isReady = self.ready()
+            body = b'ready\n' if isReady else b'starting\n'
+            self.send_response(200 if isReady else 503)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        #scrapes are too frequent to log
+        pass
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY, ready=None):
+    """Serve /metrics on a background thread, returns the server (call shutdown() to stop it).
+
+    When ready is given, /ready answers 200 while ready() is true and 503 otherwise.
+    """
+    handler = type('MetricsRequestHandler', (_MetricsRequestHandler,), {'registry': registry, 'ready': staticmethod(ready) if ready else None})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True)
+    thread.start()
+    logger.info('Serving metrics on http://%s:%d/metrics', host, server.server_address[1])
+    return server
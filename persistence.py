@@ -0,0 +1,147 @@
+"""
+SQLite persistence for NamjaNinjaBot sessions so that logins survive restarts and deploys.
+"""
+
+import logging
+import pickle
+import sqlite3
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+from telegram.ext.utils.promise import Promise
+
+logger = logging.getLogger(__name__)
+
+
+class SQLitePersistence(BasePersistence):
+    """Stores user_data and conversation states in an SQLite file.
+
+    Everything is bulk loaded once at startup. Updates are only recorded in memory by the handler
+    threads and written to disk in batches by a background thread every `flush_interval` seconds,
+    so handlers never wait on disk. flush() writes whatever is pending, PTB calls it on shutdown.
+
+    Shard workers sharing the file pass `shard` as (index, count): only the users and chats with
+    id % count == index, the ones routed to that worker, are loaded and saved, so a worker never
+    writes or deletes the rows of another one. The user of a group chat routed to the worker is kept
+    in memory only.
+    """
+
+    def __init__(self, path, flush_interval=5, user_data_type=dict, shard=None):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.path = path
+        self.shard = shard
+        self.flush_interval = flush_interval
+        self.user_data_type = user_data_type
+        self._pendingUsers = {}  # user_id -> pickled data, None to delete
+        self._pendingConversations = {}  # (name, pickled key) -> pickled state, None to delete
+        self._pendingLock = threading.Lock()
+        self._dbLock = threading.Lock()
+        self._stopped = threading.Event()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key BLOB NOT NULL, state BLOB NOT NULL, PRIMARY KEY (name, key))')
+        self._db.commit()
+        self.user_data, self.conversations = self._load()
+        self._thread = threading.Thread(target=self._run, name='SQLitePersistence', daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        user_data = defaultdict(self.user_data_type)
+        conversations = defaultdict(dict)
+        with self._dbLock:
+            for user_id, data in self._db.execute('SELECT user_id, data FROM user_data'):
+                if self._owns(user_id):
+                    user_data[user_id] = self.user_data_type(pickle.loads(data))
+            for name, key, state in self._db.execute('SELECT name, key, state FROM conversations'):
+                key = pickle.loads(key)
+                #keys start with the chat id, which updates are sharded by
+                if self._owns(key[0]):
+                    conversations[name][key] = pickle.loads(state)
+        logger.info('Loaded %d sessions from %s', len(user_data), self.path)
+        return user_data, conversations
+
+    def _owns(self, chat_id):
+        return self.shard is None or chat_id % self.shard[1] == self.shard[0]
+
+    #user_data holds no Bot instances, so the deep copies PTB makes to swap them out are skipped
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def insert_bot(self, obj):
+        return obj
+
+    def get_user_data(self):
+        return self.user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return self.conversations[name]
+
+    def update_user_data(self, user_id, data):
+        if not self._owns(user_id):
+            return
+        #serialised here, later changes made by handlers must not leak into this snapshot. Stored as a
+        #plain dict whatever user_data_type is
+        data = pickle.dumps(dict(data))
+        with self._pendingLock:
+            self._pendingUsers[user_id] = data
+
+    def drop_user_data(self, user_id):
+        """Delete a user's data, e.g. when their session is evicted"""
+        if not self._owns(user_id):
+            return
+        with self._pendingLock:
+            self._pendingUsers[user_id] = None
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def update_conversation(self, name, key, new_state):
+        if not self._owns(key[0]):
+            return
+        while isinstance(new_state, tuple) and len(new_state) == 2 and isinstance(new_state[1], Promise):
+            #async handler still running, keep the state it started from. PTB passes
+            #((old state, promise), promise) so it is unwrapped until the old state
+            new_state = new_state[0]
+        state = None if new_state is None else pickle.dumps(new_state)
+        with self._pendingLock:
+            self._pendingConversations[(name, pickle.dumps(key))] = state
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self._write()
+            except Exception:
+                logger.exception('Failed to write sessions to %s', self.path)
+
+    def _write(self):
+        #the db lock is taken first so that batches reach the disk in the order they were taken
+        with self._dbLock, self._db:
+            with self._pendingLock:
+                users, self._pendingUsers = self._pendingUsers, {}
+                conversations, self._pendingConversations = self._pendingConversations, {}
+            if not users and not conversations:
+                return
+            self._db.executemany('INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',
+                                 [(user_id, data) for user_id, data in users.items() if data is not None])
+            self._db.executemany('DELETE FROM user_data WHERE user_id = ?',
+                                 [(user_id,) for user_id, data in users.items() if data is None])
+            self._db.executemany('INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                                 [(name, key, state) for (name, key), state in conversations.items() if state is not None])
+            self._db.executemany('DELETE FROM conversations WHERE name = ? AND key = ?',
+                                 [(name, key) for (name, key), state in conversations.items() if state is None])
+
+    def flush(self):
+        self._stopped.set()
+        self._write()
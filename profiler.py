@@ -0,0 +1,91 @@
+"""
+On-demand profiler for NamjaNinjaBot: cProfile of a sample of handler calls, reported per handler and query.
+"""
+
+import cProfile
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    """Profiles a fraction of the handler calls made during a time window.
+
+    metrics.instrument hands each call to call(), which only checks `enabled` while the profiler is
+    off. The profiles are merged per handler and query label and report() renders them as text.
+    Only sync handlers are profiled, coroutines share the event loop's thread with each other.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.rate = 0.0
+        self._until = 0
+        self._started = None
+        self._stats = {}  # label -> [pstats.Stats, calls, seconds]
+        self._lock = threading.Lock()
+
+    def start(self, seconds, rate):
+        """Profile `rate` of the calls for the next `seconds`, dropping the previous results"""
+        with self._lock:
+            self._stats = {}
+            self.rate = rate
+            self._started = datetime.now()
+            self._until = time.monotonic()+seconds
+            self.enabled = True
+        logger.info('Profiling %.0f%% of updates for %ss', rate*100, seconds, extra={'event': 'profile_start'})
+
+    def stop(self):
+        self.enabled = False
+
+    def call(self, label, func, *args):
+        """func(*args), profiled if it is sampled"""
+        if time.monotonic() > self._until:
+            self.enabled = False
+            return func(*args)
+        if random.random() >= self.rate:
+            return func(*args)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            #another profiler is active on this thread
+            return func(*args)
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            self._add(label, profile, time.perf_counter()-started)
+
+    def _add(self, label, profile, seconds):
+        with self._lock:
+            entry = self._stats.get(label)
+            if entry is None:
+                self._stats[label] = [pstats.Stats(profile), 1, seconds]
+            else:
+                entry[0].add(profile)
+                entry[1] += 1
+                entry[2] += seconds
+
+    def report(self, limit=25):
+        """Text report of the profiled calls per label, slowest labels first, top `limit` functions each"""
+        out = io.StringIO()
+        with self._lock:
+            entries = sorted(self._stats.items(), key=lambda item: -item[1][2])
+            started = self._started.strftime('%Y-%m-%d %H:%M:%S') if self._started else 'never'
+            out.write('NamjaNinjaBot profile started %s, %.0f%% of updates sampled, %d profiled\n'
+                      % (started, self.rate*100, sum(entry[1] for _, entry in entries)))
+            for label, (stats, calls, seconds) in entries:
+                out.write('\n== %s: %d calls, %.1f ms total, %.1f ms mean ==\n' % (label, calls, seconds*1000, seconds*1000/calls))
+                stats.stream = out
+                stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+
+PROFILER = Profiler()
@@ -0,0 +1,69 @@
+"""
+Token bucket rate limiting.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Holds up to `capacity` tokens, refilled at `rate` tokens per second"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens+(now-self.updated)*self.rate)
+        self.updated = now
+
+    def consume(self, n=1, now=None):
+        """Take n tokens if available. Not thread safe, callers lock"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def wait_time(self, n=1, now=None):
+        """Seconds until n tokens are available"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= n:
+            return 0
+        return (n-self.tokens)/self.rate
+
+
+class RateLimiter:
+    """A TokenBucket per key, e.g. per Telegram id.
+
+    At most `max_keys` buckets are kept. The least recently used ones are dropped first, which
+    only ever makes the limiter more lenient for those keys.
+    """
+
+    def __init__(self, rate, capacity, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def allow(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            if bucket.consume():
+                self.allowed += 1
+                return True
+            self.limited += 1
+            return False
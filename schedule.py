@@ -0,0 +1,146 @@
+"""
+Parsed NDP training schedule used to answer the schedule queries.
+"""
+
+import json
+import re
+import zlib
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime
+from typing import NamedTuple, Optional
+from zoneinfo import ZoneInfo
+
+SGT = ZoneInfo('Singapore')
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Activity flags, set once per activity when a schedule is loaded
+POST_CELEBRATION = 1
+NDP_DAY = 2
+ATTIRE = 4  # reply lists the training attire
+BRING_LIST = 8  # reply lists the things to bring, for activities that also need attire
+COSTUME = 16  # costume is added to the things to bring
+ZOOM = 32  # reply includes the zoom link
+
+# (flag, Activity field, test) rules. An activity gets the flag when the test is true for the field's value
+RULES = (
+    (POST_CELEBRATION, 'title', re.compile("^NDP [0-9][0-9][0-9][0-9] Post Celebration$").search),
+    (NDP_DAY, 'end', lambda end: end is not None and end.day == 9 and end.month == 8),
+    (ATTIRE, 'title', re.compile("^NDP (Training[a-zA-Z1-4]*|[NC][ER] [1-3]|Preview|2022)").match),
+    (BRING_LIST, 'location', frozenset(("Floating Platform", "Senja Soka Centre")).__contains__),
+    (COSTUME, 'title', re.compile("^NDP ([NC][ER] [1-3]|Preview|2022)").match),
+    (ZOOM, 'location', "Zoom".__eq__),
+)
+
+
+class Activity(NamedTuple):
+    title: str
+    location: str
+    note: str
+    start: Optional[datetime]  # None when TBA
+    end: Optional[datetime]  # None when TBA
+    flags: int = 0
+
+
+def classify(activity):
+    """Flags of an activity according to RULES"""
+    flags = 0
+    for flag, field, test in RULES:
+        if test(getattr(activity, field)):
+            flags |= flag
+    return flags
+
+
+def parse_datetime(value):
+    if value == "TBA":
+        return None
+    return datetime.strptime(value, DATETIME_FORMAT).replace(tzinfo=SGT)
+
+
+class ScheduleIndex:
+    """Immutable view of the training list, parsed and classified once and sorted by end time.
+
+    Activities without an end time are kept separately in `tba`, in backend order. `version` is a
+    checksum of the schedule contents and changes whenever the backend schedule does.
+    """
+    __slots__ = ('activities', 'tba', 'ndp_day', 'post_celebration', 'version', '_ends')
+
+    def __init__(self, items):
+        self.version = zlib.crc32(json.dumps(items, sort_keys=True).encode())
+        dated = []
+        tba = []
+        ndp_day = None
+        post_celebration = None
+        for item in items:
+            activity = Activity(item["title"], item["location"], item["Note"],
+                                parse_datetime(item["datetime_start"]), parse_datetime(item["datetime_end"]))
+            activity = activity._replace(flags=classify(activity))
+            if activity.flags & POST_CELEBRATION:
+                post_celebration = activity
+            if activity.flags & NDP_DAY:
+                ndp_day = activity
+            if activity.end is None:
+                tba.append(activity)
+            else:
+                dated.append(activity)
+        #stable sort keeps backend order for activities ending at the same time
+        dated.sort(key=lambda a: a.end)
+        self.activities = tuple(dated)
+        self.tba = tuple(tba)
+        self.ndp_day = ndp_day
+        self.post_celebration = post_celebration
+        self._ends = [a.end for a in dated]
+
+    def __len__(self):
+        return len(self.activities)+len(self.tba)
+
+    def _first_after(self, now):
+        return bisect_right(self._ends, now)
+
+    def next_activity(self, now):
+        """Activity with the nearest end time after now, or None"""
+        i = self._first_after(now)
+        if i < len(self.activities):
+            return self.activities[i]
+        return None
+
+    def remaining(self, now):
+        """Activities that have not ended yet by end time, followed by the TBA ones"""
+        return self.activities[self._first_after(now):]+self.tba
+
+
+class ScheduleSnapshot(NamedTuple):
+    """Training list and details that the handlers answer from, replaced as a whole when the backend changes"""
+    training: ScheduleIndex
+    details: dict
+    fetched: float  # time.monotonic() when the training list was fetched
+
+
+class ScheduleDiff(NamedTuple):
+    added: tuple
+    changed: tuple  # (old, new) activity pairs
+    removed: tuple
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+
+def diff(old, new):
+    """Activities added, changed and removed from one ScheduleIndex to the next.
+
+    Activities are matched by title, and activities with the same title by their order of end time.
+    """
+    def by_key(index):
+        seen = Counter()
+        keyed = {}
+        for activity in index.activities+index.tba:
+            seen[activity.title] += 1
+            keyed[(activity.title, seen[activity.title])] = activity
+        return keyed
+    before = by_key(old)
+    after = by_key(new)
+    return ScheduleDiff(
+        added=tuple(activity for key, activity in after.items() if key not in before),
+        changed=tuple((before[key], activity) for key, activity in after.items() if key in before and before[key] != activity),
+        removed=tuple(activity for key, activity in before.items() if key not in after),
+    )
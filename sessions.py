@@ -0,0 +1,451 @@
+"""
+Session store for NamjaNinjaBot: user_data and conversation states that several bot processes can share.
+
+    SESSION_AUTHKEY=<secret> python -m sessions --port 7700    # serves a store
+
+Stores and their clients exchange pickles, so anyone who can connect with the authkey can run code on
+the other side. There is no default authkey, and the port should only be reachable by the bots.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+from collections.abc import MutableMapping
+from multiprocessing.managers import BaseManager
+
+from telegram.ext import ConversationHandler
+from telegram.ext.utils.promise import Promise
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SESSIONS_EVICTED = metrics.REGISTRY.counter('namjaninjabot_sessions_evicted_total', 'Sessions evicted, by reason', ('reason',))
+
+# Seconds a user's session stays locked if its holder never releases it, e.g. because its process died
+LEASE = 60
+
+# Seconds between a coroutine handler's attempts to lock a session that another process holds
+CHECKOUT_POLL = 0.05
+
+
+class Session(MutableMapping):
+    """user_data of one user, with a slot per key the handlers use instead of a dict.
+
+    Other keys go to a dict that is only created when one is set. lastSeen is the time.time() of the
+    user's last update and is not one of the keys.
+    """
+    FIELDS = ('token', 'participantCode', 'loginTime', 'cancelCmd', 'loginTries', 'loginTriesNonText', 'feedbackTriesNonText')
+    __slots__ = FIELDS+('extra', 'lastSeen')
+
+    def __init__(self, data=()):
+        self.extra = None
+        self.lastSeen = time.time()
+        self.update(data)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        else:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra is not None:
+            yield from list(self.extra)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'Session(%r)' % dict(self)
+
+    @property
+    def authenticated(self):
+        return bool(getattr(self, 'token', None) and getattr(self, 'participantCode', None))
+
+    def size(self):
+        """Approximate bytes used by the session and its values"""
+        size = sys.getsizeof(self)+sum(sys.getsizeof(value) for value in self.values())
+        if self.extra is not None:
+            size += sys.getsizeof(self.extra)
+        return size
+
+
+def evict_sessions(sessions, idle_ttl, anonymous_ttl, max_sessions=None, keep=(), now=None):
+    """Delete idle sessions from `sessions`, a dict of user id -> Session. Returns the evicted user ids.
+
+    Sessions that never logged in are evicted after `anonymous_ttl` seconds without an update, logged
+    in ones after `idle_ttl` (0 keeps them). Beyond `max_sessions`, the least recently seen are
+    evicted, the ones that never logged in first. User ids in `keep` are never evicted.
+    """
+    now = time.time() if now is None else now
+    evicted = []
+    live = []
+    for user_id, session in list(sessions.items()):
+        if user_id in keep:
+            continue
+        if session.authenticated:
+            reason = 'idle' if idle_ttl and now-session.lastSeen > idle_ttl else None
+        else:
+            reason = 'anonymous' if now-session.lastSeen > anonymous_ttl else None
+        if reason is None:
+            live.append((session.authenticated, session.lastSeen, user_id))
+        else:
+            evicted.append(user_id)
+            SESSIONS_EVICTED.inc(reason)
+    excess = len(sessions)-len(evicted)-max_sessions if max_sessions else 0
+    if excess > 0:
+        live.sort()
+        for _, _, user_id in live[:excess]:
+            evicted.append(user_id)
+            SESSIONS_EVICTED.inc('capacity')
+    for user_id in evicted:
+        sessions.pop(user_id, None)
+    return evicted
+
+
+def session_stats(sessions):
+    """Live and logged in sessions and the bytes they use"""
+    values = list(sessions.values())
+    return {'live': len(values), 'authenticated': sum(1 for session in values if session.authenticated),
+            'bytes': sum(session.size() for session in values)}
+
+
+class MemorySessionStore:
+    """Sessions in a dict, with a lock per user.
+
+    checkout() locks a user's session and returns a copy of it, checkin() saves it and releases the
+    lock, so a handler holds the lock for its whole run with two calls. Locks are leases that expire
+    after `lease` seconds. Also the stand-in for SessionServer in tests.
+    """
+
+    def __init__(self, lease=LEASE):
+        self.lease = lease
+        self._users = {}
+        self._states = {}
+        self._leases = {}  # user id -> lease expiry
+        self._cond = threading.Condition()
+
+    def checkout(self, user_id, timeout=30):
+        """Lock a user's session and return (locked, data). locked is False if the lock timed out"""
+        deadline = time.monotonic()+timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                expires = self._leases.get(user_id)
+                if expires is None or expires <= now:
+                    self._leases[user_id] = now+self.lease
+                    locked = True
+                    break
+                if now >= deadline:
+                    locked = False
+                    break
+                self._cond.wait(min(deadline, expires)-now)
+            return locked, dict(self._users.get(user_id, {}))
+
+    def checkin(self, user_id, data, locked=True):
+        """Save a user's session, or delete it when data is empty, and release the lock taken by checkout"""
+        with self._cond:
+            if data:
+                self._users[user_id] = Session(data)
+            else:
+                self._users.pop(user_id, None)
+            if locked:
+                self._leases.pop(user_id, None)
+                self._cond.notify_all()
+
+    def get(self, user_id):
+        with self._cond:
+            return dict(self._users.get(user_id, {}))
+
+    def users(self):
+        with self._cond:
+            return {user_id: dict(data) for user_id, data in self._users.items()}
+
+    def get_state(self, name, key):
+        return self._states.get((name, key))
+
+    def set_state(self, name, key, state):
+        with self._cond:
+            if state is None:
+                self._states.pop((name, key), None)
+            else:
+                self._states[(name, key)] = state
+
+    def evict(self, idle_ttl, anonymous_ttl, max_sessions=None):
+        """evict_sessions() on the stored sessions, their conversation states go with them"""
+        with self._cond:
+            evicted = set(evict_sessions(self._users, idle_ttl, anonymous_ttl, max_sessions, keep=set(self._leases)))
+            for name, key in list(self._states):
+                if key[-1] in evicted:
+                    del self._states[(name, key)]
+            return len(evicted)
+
+    def stats(self):
+        with self._cond:
+            return dict(session_stats(self._users), conversations=len(self._states), locked=len(self._leases))
+
+
+class _StoreManager(BaseManager):
+    pass
+
+
+def _check_authkey(authkey):
+    if not authkey:
+        raise ValueError('An authkey is required to serve or connect to a session store')
+
+
+class SessionServer:
+    """Serves one MemorySessionStore to other processes over TCP"""
+
+    def __init__(self, address=('127.0.0.1', 0), authkey=None):
+        _check_authkey(authkey)
+        self.store = MemorySessionStore()
+        manager = type('SessionManager', (BaseManager,), {})
+        manager.register('store', callable=lambda: self.store)
+        self._server = manager(address, authkey).get_server()
+        self.address = self._server.address
+
+    def serve_forever(self):
+        logger.info('Serving sessions on %s:%d', *self.address)
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve on a background thread"""
+        threading.Thread(target=self.serve_forever, name='SessionServer', daemon=True).start()
+        return self
+
+
+_StoreManager.register('store')
+
+
+class RemoteSessionStore:
+    """Client of a SessionServer, with the MemorySessionStore interface.
+
+    Every call is one round trip to the server. Connections are per thread.
+    """
+
+    def __init__(self, address, authkey):
+        _check_authkey(authkey)
+        manager = _StoreManager(address, authkey)
+        manager.connect()
+        self._store = manager.store()
+
+    def __getattr__(self, name):
+        if name in ('checkout', 'checkin', 'get', 'users', 'get_state', 'set_state', 'evict', 'stats'):
+            return getattr(self._store, name)
+        raise AttributeError(name)
+
+
+def open_store(spec, authkey=None):
+    """"memory" for an in-process store, "host:port" for a SessionServer, which needs its authkey"""
+    if spec == 'memory':
+        return MemorySessionStore()
+    host, port = spec.rsplit(':', 1)
+    return RemoteSessionStore((host, int(port)), authkey)
+
+
+class ConversationStates(MutableMapping):
+    """ConversationHandler.conversations backed by a session store.
+
+    While an async handler runs, ConversationHandler stores (old state, Promise) for its key. That
+    stays in this process and the store keeps the old state until the handler returns, then the
+    new state is written to the store so that other processes see it right away.
+
+    ConversationHandler reads the state before bind_user_data() locks the user's session, so the lock
+    does not order two updates of a user handled by different processes at the same time. All the
+    updates of a chat have to reach the same process, as with SHARDS, for them to be routed in order.
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _settle(self, key, state):
+        with self._lock:
+            if self._pending.get(key) is not state:
+                return
+            del self._pending[key]
+        old, promise = state
+        try:
+            new = promise.result(0)
+        except Exception:
+            new = old
+        if new == ConversationHandler.END:
+            self.store.set_state(self.name, key, None)
+        elif new is not None:
+            self.store.set_state(self.name, key, new)
+
+    def __getitem__(self, key):
+        state = self._pending.get(key)
+        if state is not None:
+            if not state[1].done.wait(0):
+                return state
+            self._settle(key, state)
+        state = self.store.get_state(self.name, key)
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key, state):
+        if isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], Promise):
+            with self._lock:
+                self._pending[key] = state
+            state[1].add_done_callback(lambda result: self._settle(key, state))
+            return
+        with self._lock:
+            self._pending.pop(key, None)
+        self.store.set_state(self.name, key, state)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+        self.store.set_state(self.name, key, None)
+
+    def __iter__(self):
+        #only the keys of this process, the store is not enumerated
+        return iter(list(self._pending))
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class _UserLocks:
+    """asyncio locks per user id, dropped once nobody holds or waits for them. Only used on the event loop"""
+
+    def __init__(self):
+        self._locks = {}  # user id -> [asyncio.Lock, holders and waiters]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, user_id):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+
+
+# store -> _UserLocks shared by the coroutine handlers bound to it
+_userLocks = weakref.WeakKeyDictionary()
+
+
+def bind_user_data(handler, store, timeout=30):
+    """Wrap a handler so that context.user_data is loaded from and saved to the session store.
+
+    The user's session is locked while the handler runs, so the same user is never handled by two
+    processes at once. Works for sync handlers and coroutine handlers. Coroutine handlers of the
+    same user wait for each other on an asyncio lock and then poll the store without blocking,
+    so a user's extra updates never hold the threads the handler holding the lock needs to finish.
+    """
+    def load(context, user_id, locked, data):
+        if not locked:
+            logger.warning('Session of %s still locked after %ss, handling the update anyway', user_id, timeout)
+        context.user_data.clear()
+        context.user_data.update(data)
+        return user_id, locked, data
+
+    def checkout(update, context):
+        if update.effective_user is None:
+            return None
+        user_id = update.effective_user.id
+        return load(context, user_id, *store.checkout(user_id, timeout))
+
+    async def checkout_async(loop, update, context):
+        user_id = update.effective_user.id
+        deadline = time.monotonic()+timeout
+        while True:
+            locked, data = await loop.run_in_executor(None, store.checkout, user_id, 0)
+            if locked or time.monotonic() >= deadline:
+                return load(context, user_id, locked, data)
+            await asyncio.sleep(CHECKOUT_POLL)
+
+    def checkin(context, session):
+        if session is None:
+            return
+        user_id, locked, data = session
+        if dict(context.user_data) != data or locked:
+            store.checkin(user_id, dict(context.user_data), locked)
+
+    if asyncio.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if update.effective_user is None:
+                return await handler(update, context)
+            loop = asyncio.get_running_loop()
+            locks = _userLocks.get(store)
+            if locks is None:
+                locks = _userLocks[store] = _UserLocks()
+            async with locks.hold(update.effective_user.id):
+                session = await checkout_async(loop, update, context)
+                try:
+                    return await handler(update, context)
+                finally:
+                    await loop.run_in_executor(None, checkin, context, session)
+    else:
+        @functools.wraps(handler)
+        def wrapper(update, context):
+            session = checkout(update, context)
+            try:
+                return handler(update, context)
+            finally:
+                checkin(context, session)
+    return wrapper
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7700)
+    args = parser.parse_args()
+    authkey = os.environ.get("SESSION_AUTHKEY", "").encode()
+    if not authkey:
+        parser.error('SESSION_AUTHKEY must be set to the secret the bots connect with')
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    SessionServer((args.host, args.port), authkey).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Multi-process dispatch for NamjaNinjaBot: updates are sharded by chat id across worker processes.
+
+The webhook process only routes updates. Each worker imports the bot and runs its own dispatcher,
+which handles the updates of its chats one at a time and in order, so conversation states stay
+correct while different chats are handled on different cores.
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SHARD_UPDATES = metrics.REGISTRY.counter('namjaninjabot_shard_updates_total', 'Updates routed to each worker process', ('shard',))
+SHARD_RESTARTS = metrics.REGISTRY.counter('namjaninjabot_shard_restarts_total', 'Worker processes restarted after dying', ('shard',))
+
+
+def shard_key(update):
+    """Chat id of an update, or user id when it has no chat. All updates of a chat go to the same shard"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+
+def run_worker(index, count, updates):
+    """Worker process: runs the bot's dispatcher on the updates routed to shard `index`"""
+    #the router process decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.environ['SHARD_INDEX'] = str(index)
+    import bot
+    from telegram import Update
+    updater = bot.build_updater()
+    if bot.METRICS_PORT:
+        metrics.serve(bot.METRICS_PORT+1+index, bot.METRICS_HOST, ready=bot.ready.is_set)
+    bot.warm_up(updater)
+    dispatcher = updater.dispatcher
+    ready = threading.Event()
+    updater.job_queue.start()
+    threading.Thread(target=dispatcher.start, kwargs={'ready': ready}, name='dispatcher', daemon=True).start()
+    ready.wait()
+    logger.info('Shard %d of %d ready', index, count)
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        updater.update_queue.put(Update.de_json(data, updater.bot))
+    #let the dispatcher finish what was routed before the stop
+    deadline = time.monotonic()+10
+    while not updater.update_queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    dispatcher.stop()
+    updater.job_queue.stop()
+    if dispatcher.persistence is not None:
+        dispatcher.update_persistence()
+        dispatcher.persistence.flush()
+    bot.shutdown()
+    logger.info('Shard %d stopped', index)
+
+
+class ShardRouter:
+    """Starts `count` worker processes and routes updates to them by shard_key.
+
+    route() is a dispatcher callback for the webhook process. A worker that has died is started
+    again on its queue, so the updates waiting for it are not lost.
+    """
+
+    def __init__(self, count, target=run_worker, queue_size=10000):
+        self.count = count
+        self.target = target
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue(queue_size) for _ in range(count)]
+        self.processes = [None]*count
+        self._lock = threading.Lock()
+
+    def _start(self, index):
+        process = self._context.Process(target=self.target, args=(index, self.count, self.queues[index]),
+                                        name='shard-%d' % index, daemon=True)
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(self.count):
+            self._start(index)
+        logger.info('Started %d shard workers', self.count)
+        return self
+
+    def route(self, update, context=None):
+        index = shard_key(update) % self.count
+        if not self.processes[index].is_alive():
+            with self._lock:
+                if not self.processes[index].is_alive():
+                    logger.error('Shard %d exited with %s, restarting it', index, self.processes[index].exitcode)
+                    SHARD_RESTARTS.inc(str(index))
+                    self._start(index)
+        self.queues[index].put(update.to_dict())
+        SHARD_UPDATES.inc(str(index))
+
+    def depth(self):
+        """Updates waiting per shard. Approximate, and not available on every platform"""
+        try:
+            return {(str(index),): queue.qsize() for index, queue in enumerate(self.queues)}
+        except NotImplementedError:
+            return {}
+
+    def stop(self, timeout=30):
+        for queue in self.queues:
+            queue.put(None)
+        deadline = time.monotonic()+timeout
+        for index, process in enumerate(self.processes):
+            process.join(max(0, deadline-time.monotonic()))
+            if process.is_alive():
+                logger.warning('Shard %d did not stop in time, terminating it', index)
+                process.terminate()
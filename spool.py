@@ -0,0 +1,157 @@
+"""
+Disk spool for feedback submissions, drained to the backend by a background thread.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SPOOL_SUBMITTED = metrics.REGISTRY.counter('namjaninjabot_feedback_spool_total',
+                                           'Spooled feedback submissions, by outcome', ('outcome',))
+
+
+class FeedbackSpool:
+    """Append-only JSON lines file of feedback waiting to be submitted.
+
+    append() returns once the submission is on disk. A background thread sends up to `batch_size`
+    entries at a time with `submit(parts, data)`, which returns the backend response or None. An
+    entry is removed from the spool when the backend accepts it (2xx) or rejects it for good (4xx),
+    in which case it is moved to `path`.rejected. Anything else stops the batch and it is retried
+    after `interval` seconds, doubling up to `max_interval` while the backend keeps failing.
+    Delivery is at least once: an entry sent just before a crash is sent again after the restart.
+    """
+
+    def __init__(self, path, submit, batch_size=20, interval=5, max_interval=300):
+        self.path = path
+        self.submit = submit
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_interval = max_interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._entries = deque(self._load())
+        if self._entries:
+            logger.info('%d feedback submissions waiting in %s', len(self._entries), path)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='FeedbackSpool', daemon=True)
+
+    def _load(self):
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    #torn write from a crash while appending
+                    logger.warning('Skipping unreadable line in %s', self.path)
+        return entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        with self._lock:
+            self._file.close()
+
+    def append(self, parts, data):
+        """Save a submission to the spool. Returns False if it could not be written or the spool is stopped"""
+        if self._stopped.is_set():
+            return False
+        entry = {'id': uuid.uuid4().hex, 'queued': time.time(), 'parts': parts, 'data': data}
+        line = json.dumps(entry)+'\n'
+        try:
+            with self._lock:
+                self._file.write(line)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._entries.append(entry)
+        except OSError:
+            logger.exception('Unable to write feedback to %s', self.path)
+            return False
+        SPOOL_SUBMITTED.inc('spooled')
+        self._wake.set()
+        return True
+
+    def _rewrite(self):
+        #must be called with the lock held. Writes the remaining entries to a new file and swaps it in
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for entry in self._entries:
+                f.write(json.dumps(entry)+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _reject(self, entry, status):
+        logger.error('Backend rejected feedback %s with %s, moved to %s.rejected', entry['id'], status, self.path)
+        with open(self.path+'.rejected', 'a', encoding='utf-8') as f:
+            f.write(json.dumps(dict(entry, status=status))+'\n')
+
+    def drain(self):
+        """Send one batch. Returns False if the backend failed and the rest should wait"""
+        with self._lock:
+            batch = list(self._entries)[:self.batch_size]
+        done = 0
+        ok = True
+        for entry in batch:
+            response = self.submit(entry['parts'], entry['data'])
+            status = None if response is None else response.status_code
+            if status is not None and 200 <= status < 300:
+                SPOOL_SUBMITTED.inc('submitted')
+            elif status is not None and 400 <= status < 500 and status not in (408, 429):
+                SPOOL_SUBMITTED.inc('rejected')
+                self._reject(entry, status)
+            else:
+                SPOOL_SUBMITTED.inc('retried')
+                ok = False
+                break
+            done += 1
+        if done:
+            with self._lock:
+                for _ in range(done):
+                    self._entries.popleft()
+                self._rewrite()
+        return ok
+
+    def _run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            if failures:
+                #new submissions do not cut the backoff short
+                self._stopped.wait(min(self.interval*2**(failures-1), self.max_interval))
+            elif not self._entries:
+                self._wake.wait()
+            self._wake.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                ok = self.drain()
+            except Exception:
+                logger.exception('Failed to drain feedback spool')
+                ok = False
+            if ok:
+                failures = 0
+            else:
+                failures += 1
+                logger.warning('Backend unavailable, %d feedback submissions waiting in %s', len(self._entries), self.path)
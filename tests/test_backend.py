@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+import requests
+
+from backend import AsyncBackendClient, BackendClient, CircuitBreaker
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def reopen(breaker):
+    #pretend the reset timeout has passed
+    breaker.opened_at -= breaker.reset_timeout
+
+
+def test_breaker_opens_after_threshold_and_lets_one_trial_through():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+    reopen(breaker)
+    assert breaker.state == 'half-open'
+    assert breaker.allow() == 'trial'
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow() is True
+
+
+def test_failed_trial_reopens_breaker():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    reopen(breaker)
+    assert breaker.allow() == 'trial'
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+
+def test_client_retries_gets_and_records_one_outcome():
+    client = BackendClient('http://backend/', retries=2, backoff=0, breaker=CircuitBreaker(threshold=1))
+    responses = [FakeResponse(503), FakeResponse(503), FakeResponse(200)]
+    client.session.request = lambda *args, **kwargs: responses.pop(0)
+    assert client.get('user', ['s']).status_code == 200
+    assert not responses and client.breaker.state == 'closed'
+    #POSTs are not retried once the backend has seen them
+    responses = [FakeResponse(503), FakeResponse(200)]
+    assert client.post('feedback', ['s']).status_code == 503
+    assert client.breaker.state == 'open'
+    assert client.get('user', ['s']) is None
+
+
+def test_trial_is_released_when_request_raises():
+    breaker = CircuitBreaker(threshold=1)
+    breaker.record_failure()
+    reopen(breaker)
+    client = BackendClient('http://backend/', breaker=breaker)
+
+    def request(*args, **kwargs):
+        raise KeyboardInterrupt
+    client.session.request = request
+    with pytest.raises(KeyboardInterrupt):
+        client.get('user', ['s'])
+    assert breaker.allow() == 'trial'
+
+
+def test_cancelled_async_trial_is_released_for_the_sync_client():
+    breaker = CircuitBreaker(threshold=1)
+    breaker.record_failure()
+    reopen(breaker)
+    client = AsyncBackendClient('http://backend/', breaker=breaker)
+
+    class HangingSession:
+        def request(self, *args, **kwargs):
+            return self
+
+        async def __aenter__(self):
+            await asyncio.sleep(60)
+
+        async def __aexit__(self, *exc):
+            return False
+    client.session = HangingSession()
+
+    async def main():
+        task = asyncio.ensure_future(client.get('user', ['s']))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(main())
+    sync = BackendClient('http://backend/', breaker=breaker)
+    sync.session.request = lambda *args, **kwargs: FakeResponse(200)
+    assert sync.get('user', ['s']).status_code == 200
+    assert breaker.state == 'closed'
+
+
+def test_client_gives_up_after_connection_errors():
+    client = BackendClient('http://backend/', retries=0, backoff=0, breaker=CircuitBreaker(threshold=1))
+    calls = []
+
+    def request(*args, **kwargs):
+        calls.append(1)
+        raise requests.exceptions.ConnectionError('refused')
+    client.session.request = request
+    assert client.post('feedback', ['s']) is None
+    #a refused connection is retried once even for POST
+    assert len(calls) == 2 and client.breaker.state == 'open'
@@ -0,0 +1,51 @@
+import asyncio
+import threading
+
+import pytest
+
+from cache import TTLCache
+
+
+def test_concurrent_misses_run_the_loader_once():
+    cache = TTLCache()
+    release = threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return 'value'
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('key', loader))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while cache.coalesced < 7:
+        release.wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['value']*8 and len(calls) == 1
+    assert cache.get_or_load('key', loader) == 'value' and len(calls) == 1
+
+
+def test_loader_errors_and_none_reach_waiters_but_are_not_cached():
+    cache = TTLCache()
+    with pytest.raises(ValueError):
+        cache.get_or_load('key', lambda: (_ for _ in ()).throw(ValueError()))
+    assert cache.get_or_load('key', lambda: None) is None
+    assert 'key' not in cache._data and not cache._inflight
+
+
+def test_async_misses_await_one_load():
+    cache = TTLCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'value'
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_load_async('key', loader) for _ in range(8)))
+    assert asyncio.run(main()) == ['value']*8
+    assert len(calls) == 1 and cache.coalesced == 7 and not cache._ainflight
@@ -0,0 +1,48 @@
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from delivery import DeliveryQueue
+
+
+@pytest.fixture
+def queue():
+    queue = DeliveryQueue(rate=1000, chat_rate=1000, chat_burst=1000, max_retries=1)
+    yield queue
+    queue.stop()
+
+
+def test_retry_after_requeues_and_pauses_every_chat(queue):
+    sent = []
+
+    def flooded():
+        if not sent:
+            sent.append(('flooded', time.monotonic()))
+            raise RetryAfter(0.3)
+        sent.append(('flooded', time.monotonic()))
+        return 'ok'
+    started = time.monotonic()
+    first = queue.submit(1, flooded)
+    time.sleep(0.05)
+    other = queue.submit(2, lambda: sent.append(('other', time.monotonic())))
+    assert first.result(5) == 'ok'
+    other.result(5)
+    #the second chat waited for the pause too
+    assert all(at-started >= 0.25 for name, at in sent[1:])
+
+
+def test_retry_after_gives_up_after_max_retries(queue):
+    def flooded():
+        raise RetryAfter(0.05)
+    with pytest.raises(RetryAfter):
+        queue.submit(1, flooded).result(5)
+    assert queue.send(1, lambda: 'next') == 'next'
+
+
+def test_calls_to_one_chat_are_sent_in_order(queue):
+    sent = []
+    futures = [queue.submit(1, sent.append, i) for i in range(20)]
+    for future in futures:
+        future.result(5)
+    assert sent == list(range(20))
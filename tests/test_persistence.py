@@ -0,0 +1,64 @@
+from telegram.ext.utils.promise import Promise
+
+from persistence import SQLitePersistence
+from sessions import Session
+
+
+def reopen(path, **kwargs):
+    #writes only happen on flush() within a test
+    return SQLitePersistence(path, flush_interval=60, **kwargs)
+
+
+def test_flush_round_trip(tmp_path):
+    path = str(tmp_path/'sessions.db')
+    persistence = reopen(path, user_data_type=Session)
+    persistence.update_user_data(1, Session({'token': 't', 'participantCode': 'P1'}))
+    persistence.update_conversation('login', (1, 1), 2)
+    persistence.update_conversation('feedback', (1, 1), 3)
+    persistence.update_conversation('feedback', (1, 1), None)
+    persistence.flush()
+    loaded = reopen(path, user_data_type=Session)
+    assert isinstance(loaded.user_data[1], Session)
+    assert dict(loaded.user_data[1]) == {'token': 't', 'participantCode': 'P1'}
+    assert loaded.get_conversations('login') == {(1, 1): 2}
+    assert loaded.get_conversations('feedback') == {}
+
+
+def test_shards_only_load_and_save_their_own_ids(tmp_path):
+    path = str(tmp_path/'sessions.db')
+    persistence = reopen(path)
+    for user_id in (1, 2, 3, 4):
+        persistence.update_user_data(user_id, {'token': 'old%d' % user_id})
+    persistence.update_conversation('login', (3, 3), 1)
+    persistence.update_conversation('login', (4, 4), 1)
+    persistence.flush()
+
+    even = reopen(path, shard=(0, 2))
+    odd = reopen(path, shard=(1, 2))
+    assert sorted(even.user_data) == [2, 4]
+    assert sorted(odd.user_data) == [1, 3]
+    assert even.get_conversations('login') == {(4, 4): 1}
+
+    odd.update_user_data(3, {'token': 'new3'})
+    odd.flush()
+    #a user of another shard, e.g. seen in a group chat routed to this one, is never written or deleted
+    even.update_user_data(3, {})
+    even.drop_user_data(1)
+    even.update_conversation('login', (3, 3), None)
+    even.flush()
+
+    loaded = reopen(path)
+    assert {user_id: dict(data) for user_id, data in loaded.user_data.items()} == {
+        1: {'token': 'old1'}, 2: {'token': 'old2'}, 3: {'token': 'new3'}, 4: {'token': 'old4'}}
+    assert loaded.get_conversations('login') == {(3, 3): 1, (4, 4): 1}
+    loaded.flush()
+
+
+def test_pending_async_state_keeps_the_old_state(tmp_path):
+    path = str(tmp_path/'sessions.db')
+    persistence = reopen(path)
+    promise = Promise(lambda: 5, (), {})
+    #ConversationHandler passes ((old state, promise), promise)
+    persistence.update_conversation('login', (1, 1), ((2, promise), promise))
+    persistence.flush()
+    assert reopen(path).get_conversations('login') == {(1, 1): 2}
@@ -0,0 +1,74 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from sessions import MemorySessionStore, Session, bind_user_data, evict_sessions
+
+
+def make_update(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+
+def test_checkout_locks_until_checkin():
+    store = MemorySessionStore()
+    assert store.checkout(1) == (True, {})
+    assert store.checkout(1, timeout=0) == (False, {})
+    store.checkin(1, {'token': 't'})
+    assert store.checkout(1, timeout=0) == (True, {'token': 't'})
+
+
+def test_lease_expires():
+    store = MemorySessionStore(lease=0.05)
+    store.checkout(1)
+    locked, _ = store.checkout(1, timeout=1)
+    assert locked
+
+
+def test_async_handlers_of_one_user_do_not_starve_other_users():
+    #the first handler of user 1 holds the lease and needs an executor thread to finish, while more
+    #updates of user 1 wait for the lease. Other users must not wait for them
+    store = MemorySessionStore()
+    answered = {}
+
+    async def handler(update, context):
+        await asyncio.get_running_loop().run_in_executor(None, time.sleep, 0.05)
+        context.user_data['count'] = context.user_data.get('count', 0)+1
+        answered.setdefault(update.effective_user.id, []).append(time.monotonic())
+
+    wrapped = bind_user_data(handler, store, timeout=30)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=2))
+        started = time.monotonic()
+        contexts = {user_id: SimpleNamespace(user_data={}) for user_id in (1, 2)}
+        taps = [wrapped(make_update(1), contexts[1]) for _ in range(6)]
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(wrapped(make_update(2), contexts[2]), 5)
+        other = time.monotonic()-started
+        await asyncio.wait_for(asyncio.gather(*taps), 10)
+        return other
+
+    other = asyncio.run(main())
+    assert other < 1
+    assert len(answered[1]) == 6
+    assert store.get(1) == {'count': 6}
+
+
+def test_session_keeps_fields_and_extra_keys():
+    session = Session({'token': 't', 'participantCode': 'P1', 'other': 1})
+    assert session.authenticated
+    assert dict(session) == {'token': 't', 'participantCode': 'P1', 'other': 1}
+    del session['other']
+    assert session.extra is None
+
+
+def test_evict_sessions():
+    now = 1000
+    sessions = {1: Session(), 2: Session({'token': 't', 'participantCode': 'P2'}), 3: Session()}
+    sessions[1].lastSeen = now-100
+    sessions[2].lastSeen = now-100
+    sessions[3].lastSeen = now
+    assert evict_sessions(sessions, idle_ttl=1000, anonymous_ttl=50, now=now) == [1]
+    assert set(sessions) == {2, 3}
@@ -0,0 +1,45 @@
+import json
+
+from spool import FeedbackSpool
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def spool_with(tmp_path, statuses):
+    sent = []
+
+    def submit(parts, data):
+        sent.append(data['n'])
+        status = statuses.pop(0)
+        return None if status is None else FakeResponse(status)
+    spool = FeedbackSpool(str(tmp_path/'feedback.jsonl'), submit)
+    for n in range(3):
+        assert spool.append(['student', 'feedback'], {'n': n})
+    return spool, sent
+
+
+def test_rejected_entries_are_moved_aside(tmp_path):
+    spool, sent = spool_with(tmp_path, [200, 400, 201])
+    assert spool.drain()
+    spool.stop()
+    assert sent == [0, 1, 2] and len(spool) == 0
+    rejected = [json.loads(line) for line in open(str(tmp_path/'feedback.jsonl.rejected'))]
+    assert [(entry['data']['n'], entry['status']) for entry in rejected] == [(1, 400)]
+    assert open(str(tmp_path/'feedback.jsonl')).read() == ''
+
+
+def test_failures_keep_the_rest_for_a_retry(tmp_path):
+    for failure in (None, 503, 429):
+        path = tmp_path/str(failure)
+        path.mkdir()
+        spool, sent = spool_with(path, [200, failure])
+        assert not spool.drain()
+        spool.stop()
+        assert sent == [0, 1] and len(spool) == 2
+        #survives a restart
+        reopened = FeedbackSpool(str(path/'feedback.jsonl'), None)
+        assert [entry['data']['n'] for entry in reopened._entries] == [1, 2]
+        reopened.stop()